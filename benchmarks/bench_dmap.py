@@ -0,0 +1,96 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+""" Compares DMAP encoding throughput of dacpy against the in-tree encoder
+
+Run from the repository root: python benchmarks/bench_dmap.py
+"""
+
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'euphony'))
+
+import dmapwriter
+
+SERVER_INFO = ('msrv', [
+    ('mstt', 200),
+    ('mpro', (2, 0, 6)),
+    ('apro', (3, 0, 8)),
+    ('minm', 'euphony'),
+    ('mslr', False),
+    ('mstm', 1800),
+    ('msal', True),
+    ('msup', True),
+    ('mspi', True),
+    ('msex', True),
+    ('msbr', True),
+    ('msqy', True),
+    ('msix', True),
+    ('msrs', True),
+    ('msdc', 1),
+])
+
+def build_items(count):
+    return ('adbs', [
+        ('mstt', 200),
+        ('muty', 0),
+        ('mtco', count),
+        ('mrco', count),
+        ('mlcl', [('mlit', [
+            ('miid', i),
+            ('mper', i),
+            ('minm', 'Song %d' % i),
+            ('asar', 'Artist %d' % (i // 100)),
+            ('asal', 'Album %d' % (i // 10)),
+            ('astn', i % 10 + 1),
+            ('astm', 180000 + i),
+        ]) for i in xrange(count)]),
+    ])
+
+def build_groups(count):
+    return ('agal', [
+        ('mstt', 200),
+        ('muty', 0),
+        ('mtco', count),
+        ('mrco', count),
+        ('mlcl', [('mlit', [
+            ('miid', i),
+            ('mper', i),
+            ('minm', 'Album %d' % i),
+            ('asaa', 'Artist %d' % (i // 10)),
+            ('mimc', 10),
+        ]) for i in xrange(count)]),
+    ])
+
+def run(encode, node, number):
+    return timeit.timeit(lambda: encode(node), number=number)
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for (label, node, repeat) in (('server-info', SERVER_INFO, number * 500),
+                                  ('groups', build_groups(1000), number),
+                                  ('items', build_items(10000), number)):
+        for (name, encode) in (('dacpy', dmapwriter.reference_encode), ('encoder', dmapwriter.encode)):
+            elapsed = run(encode, node, repeat)
+            print '%-12s %-8s %10.1f encodes/sec' % (label, name, repeat / elapsed)
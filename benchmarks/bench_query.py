@@ -0,0 +1,98 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+""" Compares query parse throughput against the original shlex-based parser
+
+Run from the repository root: python benchmarks/bench_query.py
+"""
+
+import os.path
+import re
+import shlex
+import StringIO
+import sys
+import timeit
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'euphony'))
+
+import query
+
+QUERIES = [
+    "'daap.songartist:Zaphod Beeblebrox'",
+    "'daap.songalbumid:1234'",
+    "('com.apple.itunes.mediakind:1','com.apple.itunes.mediakind:32') 'daap.songartist!:'",
+    "('com.apple.itunes.mediakind:1','com.apple.itunes.mediakind:4','com.apple.itunes.mediakind:8',"
+        "'com.apple.itunes.mediakind:2097152','com.apple.itunes.mediakind:2097156') 'daap.songalbumartist:Marvin'",
+]
+
+LEGACY_REGEX = re.compile(r'(?u)\'(?P<property>.+?)(?P<operator>!?:)(?P<value>.*)\'')
+
+def legacy_expression(token):
+    result = LEGACY_REGEX.match(token).groupdict()
+    value = urllib.unquote_plus(result['value'])
+    try:
+        value = int(value)
+    except ValueError:
+        try:
+            value = int(value, 16)
+        except ValueError:
+            pass
+    left = query.PropertyExpression(result['property'])
+    right = query.ConstantExpression(value)
+    if result['operator'] == ':':
+        return query.EqualsExpression(left, right)
+    return query.NotEqualsExpression(left, right)
+
+def legacy_group(lexer):
+    stack = []
+    while True:
+        token = lexer.get_token()
+        if token == ')' or token == '':
+            return stack.pop()
+        elif token == '(':
+            stack.append(legacy_group(lexer))
+        elif token.startswith('\''):
+            stack.append(legacy_expression(token))
+        elif token in ('+', ','):
+            next_token = lexer.get_token()
+            if next_token == '(':
+                right = legacy_group(lexer)
+            else:
+                right = legacy_expression(next_token)
+            if token == '+':
+                stack.append(query.AndExpression(stack.pop(), right))
+            else:
+                stack.append(query.OrExpression(stack.pop(), right))
+
+def legacy_parse(querystring):
+    return legacy_group(shlex.shlex(StringIO.StringIO(querystring.replace(' ', '+'))))
+
+def run(parse, number):
+    return timeit.timeit(lambda: [parse(q) for q in QUERIES], number=number)
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    total = number * len(QUERIES)
+    for (name, parse) in (('shlex', legacy_parse), ('lexer', query.parse_query_string)):
+        elapsed = run(parse, number)
+        print '%-8s %8.1f parses/sec' % (name, total / elapsed)
@@ -0,0 +1,58 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+""" Integer bitsets for posting lists
+
+A bitset is a plain (long) integer with bit n set when id n is a member, so
+AND, OR and ANDNOT are the native &, | and & ~ operators and never allocate
+per-member objects.
+"""
+
+import binascii
+
+__all__ = ['EMPTY', 'from_ids', 'full', 'iter_ids', 'count']
+
+EMPTY = 0
+
+def from_ids(ids):
+    """ Builds a bitset from a sorted sequence of ids """
+    if not ids:
+        return EMPTY
+    buf = bytearray((ids[-1] >> 3) + 1)
+    for i in ids:
+        buf[i >> 3] |= 1 << (i & 7)
+    buf.reverse()
+    return int(binascii.hexlify(buf), 16)
+
+def full(size):
+    return (1 << size) - 1
+
+def iter_ids(bits):
+    """ Yields the ids in a bitset in ascending order """
+    digits = bin(bits)[:1:-1]
+    index = digits.find('1')
+    while index >= 0:
+        yield index
+        index = digits.find('1', index + 1)
+
+def count(bits):
+    return bin(bits).count('1')
@@ -0,0 +1,72 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import threading
+
+__all__ = ['LRUCache']
+
+class LRUCache(object):
+    """ A thread-safe mapping that discards the least recently used entries
+
+    By default maxsize limits the number of entries. If sizeof is given, it
+    is called on each value and maxsize limits the sum of those sizes.
+    """
+    def __init__(self, maxsize, sizeof=None):
+        self.maxsize = maxsize
+        self.size = 0
+        self._sizeof = sizeof or (lambda value: 1)
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        if size > self.maxsize:
+            return value
+        with self._lock:
+            if key in self._data:
+                self.size -= self._sizeof(self._data.pop(key))
+            self._data[key] = value
+            self.size += size
+            while self.size > self.maxsize:
+                self.size -= self._sizeof(self._data.popitem(last=False)[1])
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
@@ -0,0 +1,88 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+""" Stable object ids and a revision-ordered log of library changes """
+
+import collections
+import threading
+
+__all__ = ['IdMap', 'ChangeLog', 'diff']
+
+class IdMap(object):
+    """ Hands out ids that stay the same for a key across library rebuilds """
+    def __init__(self, start=0):
+        self._ids = {}
+        self._next = start
+
+    def __getitem__(self, key):
+        try:
+            return self._ids[key]
+        except KeyError:
+            id = self._ids[key] = self._next
+            self._next += 1
+            return id
+
+    def __contains__(self, key):
+        return key in self._ids
+
+def diff(old, new):
+    """ Compares two id -> signature dicts, returning the (changed, deleted) id sets """
+    changed = set(id for (id, sig) in new.iteritems() if old.get(id) != sig)
+    deleted = set(old) - set(new)
+    return (changed, deleted)
+
+class ChangeLog(object):
+    """ Records which ids were added, modified or deleted at each revision
+
+    Changes are kept per scope (e.g. 'items', or a container id) for the
+    last maxsize revisions. since() can only answer for revisions at or
+    after the oldest one still held and returns None for anything older.
+    """
+    def __init__(self, maxsize, revision=0):
+        self.maxsize = maxsize
+        self.base = revision
+        self._entries = collections.deque()
+        self._lock = threading.Lock()
+
+    def record(self, revision, scope, changed=(), deleted=()):
+        if not changed and not deleted:
+            return
+        with self._lock:
+            self._entries.append((revision, scope, frozenset(changed), frozenset(deleted)))
+            while len(self._entries) > self.maxsize:
+                self.base = self._entries.popleft()[0]
+
+    def since(self, revision, scope):
+        """ Returns the (changed, deleted) id sets for a scope after a revision, or None if truncated """
+        with self._lock:
+            if revision < self.base:
+                return None
+            changed = set()
+            deleted = set()
+            for (rev, s, c, d) in self._entries:
+                if rev <= revision or s != scope:
+                    continue
+                changed -= d
+                changed |= c
+                deleted -= c
+                deleted |= d
+            return (changed, deleted)
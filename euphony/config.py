@@ -39,6 +39,9 @@ class Section(object):
         except KeyError:
             raise AttributeError('Invalid key: %r' % name)
 
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+
 class ConfigSet(object):
     def __init__(self, inifile):
         cfg = SafeConfigParser()
@@ -55,5 +58,12 @@ class ConfigSet(object):
         except KeyError:
             raise AttributeError('Invalid section: %r' % name)
 
+    def get(self, section, key, default=None):
+        """ Returns an optional setting, falling back to default if it is missing """
+        try:
+            return self[section].get(key, default)
+        except KeyError:
+            return default
+
 basepath = os.path.dirname(os.path.abspath(__file__))
 current = ConfigSet(os.path.join(basepath, 'config.ini'))
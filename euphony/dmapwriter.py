@@ -0,0 +1,181 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+""" A fast DMAP encoder and helpers for assembling responses from fragments """
+
+import struct
+
+import dacpy.types
+
+from cache import LRUCache
+
+__all__ = ['Encoder', 'encode', 'container', 'listing', 'listing_head', 'FragmentCache']
+
+HEADER = struct.Struct('>4sI')
+LENGTH = struct.Struct('>I')
+
+# Unsigned and signed tag+length+value packers by payload width
+INTEGER_PACKERS = dict(
+    (width, (struct.Struct('>4sI' + unsigned), struct.Struct('>4sI' + signed)))
+    for (width, unsigned, signed) in ((1, 'B', 'b'), (2, 'H', 'h'), (4, 'I', 'i'), (8, 'Q', 'q')))
+
+def reference_encode(node):
+    return dacpy.types.build_node(node).serialize()
+
+def delegate(encoder, tag, value, out):
+    out += reference_encode((tag, value))
+
+def write_string(encoder, tag, value, out):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    out += HEADER.pack(tag, len(value))
+    out += value
+
+def write_container(encoder, tag, value, out):
+    start = len(out)
+    out += HEADER.pack(tag, 0)
+    for child in value:
+        encoder.write(child, out)
+    LENGTH.pack_into(out, start + 4, len(out) - start - HEADER.size)
+
+def integer_writer(width):
+    (unsigned, signed) = INTEGER_PACKERS[width]
+    def write_integer(encoder, tag, value, out):
+        try:
+            if value < 0:
+                out += signed.pack(tag, width, value)
+            else:
+                out += unsigned.pack(tag, width, value)
+        except struct.error:
+            # Out of range for the width learned from dacpy; let it decide
+            delegate(encoder, tag, value, out)
+    return write_integer
+
+def writer_key(tag, value):
+    """ Groups values that dacpy encodes alike
+
+    Integers are also split by sign and bit length, so a width that dacpy
+    picks from the value rather than the tag is learned for each range.
+    """
+    if isinstance(value, (int, long)):
+        return (tag, value.__class__, value < 0, abs(value).bit_length())
+    return (tag, value.__class__)
+
+class Encoder(object):
+    """ Encodes DMAP node tuples straight into a bytearray
+
+    The writer for each (tag, value type) pair, and for integers each
+    magnitude, is compiled the first time it is seen. The candidate
+    writer is chosen from dacpy's own encoding of that node and kept only
+    if it reproduces dacpy's bytes exactly. Types it cannot specialize
+    (dates, versions, ...) stay delegated to dacpy, so output is always
+    byte-for-byte identical.
+    """
+    def __init__(self):
+        self.writers = {}
+
+    def encode(self, node):
+        out = bytearray()
+        self.write(node, out)
+        return str(out)
+
+    def write(self, node, out):
+        (tag, value) = node
+        if callable(value):
+            value = value()
+        key = writer_key(tag, value)
+        try:
+            writer = self.writers[key]
+        except KeyError:
+            writer = self.compile(key, tag, value)
+        writer(self, tag, value, out)
+
+    def compile(self, key, tag, value):
+        expected = reference_encode((tag, value))
+        if isinstance(value, list):
+            writer = write_container
+        elif isinstance(value, basestring):
+            writer = write_string
+        elif isinstance(value, (bool, int, long)) and len(expected) - HEADER.size in INTEGER_PACKERS:
+            writer = integer_writer(len(expected) - HEADER.size)
+        else:
+            writer = delegate
+
+        if writer is not delegate:
+            out = bytearray()
+            writer(self, tag, value, out)
+            if str(out) != expected:
+                writer = delegate
+        self.writers[key] = writer
+        return writer
+
+encoder = Encoder()
+
+def encode(node):
+    return encoder.encode(node)
+
+def container(tag, children):
+    """ Wraps already encoded children in a tag """
+    body = ''.join(children)
+    return HEADER.pack(tag, len(body)) + body
+
+def listing_head(tag, fields, list_tag, size, tail=''):
+    """ Encodes everything before the records of a listing whose records total size bytes """
+    head = ''.join([encode(f) for f in fields])
+    total = len(head) + HEADER.size + size + len(tail)
+    return ''.join([HEADER.pack(tag, total), head, HEADER.pack(list_tag, size)])
+
+def listing(tag, fields, list_tag, records, trailer=()):
+    """ Encodes (tag, [fields..., (list_tag, records), trailer...]) around encoded records """
+    tail = ''.join([encode(t) for t in trailer])
+    size = sum([len(r) for r in records])
+    return ''.join([listing_head(tag, fields, list_tag, size, tail)] + records + [tail])
+
+class FragmentCache(object):
+    """ Byte-bounded cache of encoded records, keyed by whatever identifies their content
+
+    The encoded length of each record is remembered separately, so the size
+    of a listing can be computed without keeping every record in memory.
+    """
+    def __init__(self, max_bytes, max_sizes=262144):
+        self._cache = LRUCache(max_bytes, sizeof=len)
+        self._sizes = LRUCache(max_sizes)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, build):
+        data = self._cache.get(key)
+        if data is None:
+            data = self._cache.put(key, encode(build()))
+            self._sizes.put(key, len(data))
+        return data
+
+    def size(self, key, build):
+        size = self._sizes.get(key)
+        if size is None:
+            size = len(self.get(key, build))
+        return size
+
+    def clear(self):
+        self._cache.clear()
+        self._sizes.clear()
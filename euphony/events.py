@@ -0,0 +1,82 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+""" Typed change events for the MPD subsystems reported by idle """
+
+import collections
+import threading
+
+__all__ = ['ChangeEvent', 'DatabaseChanged', 'StoredPlaylistChanged', 'QueueChanged',
+           'PlayerChanged', 'MixerChanged', 'OptionsChanged', 'EventBus', 'for_subsystem']
+
+class ChangeEvent(object):
+    subsystem = None
+
+class DatabaseChanged(ChangeEvent):
+    subsystem = 'database'
+
+class StoredPlaylistChanged(ChangeEvent):
+    subsystem = 'stored_playlist'
+
+class QueueChanged(ChangeEvent):
+    subsystem = 'playlist'
+
+class PlayerChanged(ChangeEvent):
+    subsystem = 'player'
+
+class MixerChanged(ChangeEvent):
+    subsystem = 'mixer'
+
+class OptionsChanged(ChangeEvent):
+    subsystem = 'options'
+
+EVENT_TYPES = dict((e.subsystem, e) for e in (DatabaseChanged, StoredPlaylistChanged, QueueChanged,
+                                              PlayerChanged, MixerChanged, OptionsChanged))
+
+def for_subsystem(subsystem):
+    """ Returns the event class for an idle subsystem name """
+    return EVENT_TYPES.get(subsystem, ChangeEvent)
+
+class EventBus(object):
+    """ Delivers events to the callbacks subscribed to their type or a base type
+
+    Callbacks run on the publishing thread, which is usually an idler.
+    """
+    def __init__(self):
+        self._subscribers = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def subscribe(self, event_type, callback):
+        with self._lock:
+            self._subscribers[event_type].append(callback)
+
+    def unsubscribe(self, event_type, callback):
+        with self._lock:
+            self._subscribers[event_type].remove(callback)
+
+    def publish(self, event):
+        with self._lock:
+            callbacks = []
+            for cls in type(event).__mro__:
+                callbacks.extend(self._subscribers.get(cls, ()))
+        for callback in callbacks:
+            callback(event)
@@ -21,8 +21,9 @@
 # THE SOFTWARE.
 
 import datetime
-import operator
+import hashlib
 import re
+import zlib
 
 from tornado import web
 
@@ -30,43 +31,438 @@ import albumart
 import constants
 import dacpy.pairing
 import dacpy.tags
-import dacpy.types
+import dmapwriter
 import euphony
+import events
 import logging
 import query
 import util
 
+from cache import LRUCache
 from config import current as config
 from db import PairingRecord
 from mpdplayer import MPD
+from propertyqueue import PropertyQueue
 
 mpd = MPD(str(config.mpd.host), int(config.mpd.port))
 
+# Maps DACP sort= values onto the sort orders precomputed by each collection
+SORT_ORDERS = {
+    'name': 'name',
+    'artist': 'artist',
+    'album': 'album',
+}
+
+SIMPLE_TERM_REGEX = re.compile(r"([^\(\),+']+?)[:!]+([^\(\),+']+)")
+
 def query_to_dict(query):
     """ Turns a **simple** query (ignores subgroups) into a dict """
-    return dict(re.findall(r"([^\(\),+']+?)[:!]+([^\(\),+']+)", query))
+    return dict(SIMPLE_TERM_REGEX.findall(query))
+
+def query_values(query, prop):
+    """ Returns every value a **simple** query gives for one property, in order """
+    return [value for (name, value) in SIMPLE_TERM_REGEX.findall(query) if name == prop]
+
+INDEX_RANGE_REGEX = re.compile(r'^(\d+)(?:-(\d*))?$')
+
+FRAGMENT_CACHE_BYTES = 16 * 1024 * 1024
+
+fragments = dmapwriter.FragmentCache(FRAGMENT_CACHE_BYTES)
+
+# Compiled meta= lists, keyed by class and property names
+EXTRACTOR_CACHE_SIZE = 256
+extractors = LRUCache(EXTRACTOR_CACHE_SIZE)
+
+RESPONSE_CACHE_BYTES = 32 * 1024 * 1024
+
+# Arguments that vary per client without affecting the response body
+UNCACHED_ARGUMENTS = ('session-id', 'revision-number')
+
+responses = LRUCache(RESPONSE_CACHE_BYTES, sizeof=lambda entry: len(entry[1]))
+
+def clear_library_caches(event):
+    """ Drops encoded records and responses of the previous library generation """
+    fragments.clear()
+    responses.clear()
+
+def clear_response_cache(event):
+    responses.clear()
+
+# Only library and playlist changes invalidate cached responses; player,
+# mixer and options events never reach them
+mpd.events.subscribe(events.DatabaseChanged, clear_library_caches)
+mpd.events.subscribe(events.StoredPlaylistChanged, clear_response_cache)
+
+COMPRESS_LEVEL = int(config.get('http', 'compress_level', 6))
+COMPRESS_MIN_SIZE = int(config.get('http', 'compress_min_size', 1024))
+
+# Encoded playstatusupdate responses, by revision
+PLAYSTATUS_CACHE_SIZE = 4
+playstatus = LRUCache(PLAYSTATUS_CACHE_SIZE)
+
+# Writes to a property within this many seconds are coalesced into one
+SETPROPERTY_WINDOW = float(config.get('http', 'setproperty_window', 0.1))
+
+property_queue = PropertyQueue(mpd, SETPROPERTY_WINDOW)
+
+# Seconds a long-poll request is held before it is answered with the current state
+LONGPOLL_TIMEOUT = int(config.get('http', 'longpoll_timeout', 300))
+
+# Supported content codings, in order of preference
+CONTENT_ENCODINGS = ('gzip', 'deflate')
+
+# Listings with more records than this are streamed in chunks
+STREAM_MIN_RECORDS = 1000
+STREAM_CHUNK_BYTES = 256 * 1024
+
+def ordered_ids(collection, query_string, order):
+    """ Returns the positions of matching objects (everything if there is no query) in a sort order """
+    return collection.ordered_ids(query_string, order)
+
+def sorted_query(collection, query_string, order):
+    return [collection[x] for x in ordered_ids(collection, query_string, order)]
+
+# Item properties that MPD can match itself, by the tag it knows them as
+FINDADD_TAGS = {
+    'daap.songartist': 'artist',
+    'daap.songalbum': 'album',
+    'daap.songgenre': 'genre',
+}
+
+def findadd_conditions(query_string):
+    """ Translates a query into findadd tag/value arguments, or None if only we can evaluate it """
+    terms = query.equality_terms(query_string)
+    if not terms:
+        return None
+    conditions = []
+    album_id = terms.pop('daap.songalbumid', None)
+    if album_id is not None:
+        album = mpd.albums.get_by_id(album_id)
+        if album is None:
+            return None
+        conditions.extend(['album', album.name, 'artist', album.artist.name])
+    for (prop, value) in terms.iteritems():
+        if prop not in FINDADD_TAGS or not isinstance(value, basestring):
+            return None
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        conditions.extend([FINDADD_TAGS[prop], value])
+    return conditions
+
+def item_sort_order(query_string, sort_type):
+    if 'daap.songalbumid' in query_string:
+        return 'album'
+    return SORT_ORDERS.get(sort_type)
+
+class PropertyExtractor(object):
+    """ A property list validated and bound to the getters of one PropertyMixin class """
+    def __init__(self, cls, properties):
+        self.properties = tuple(properties)
+        getters = []
+        for p in self.properties:
+            try:
+                code = dacpy.tags.PROPERTIES[p][0]
+            except KeyError:
+                raise web.HTTPError(404)
+            getter = cls.getter_for(p)
+            if getter is not None:
+                getters.append((code, getter))
+        self.getters = tuple(getters)
+
+    def __call__(self, source):
+        """ Returns a list of tag-value tuples from the source object """
+        result = []
+        for (code, getter) in self.getters:
+            value = getter(source)
+            if value is not None:
+                result.append((code, value))
+        return result
+
+def compile_properties(cls, properties):
+    """ Returns the cached PropertyExtractor for a class and property list """
+    key = (cls, tuple(properties))
+    extractor = extractors.get(key)
+    if extractor is None:
+        extractor = extractors.put(key, PropertyExtractor(cls, properties))
+    return extractor
 
 def fetch_properties(properties, source):
     """ Returns a list of tag-value tuples from the source object """
-    result = []
-    for p in properties:
-        try:
-            propinfo = dacpy.tags.PROPERTIES[p]
-            value = source.get_property(p)
-            if value is not None:
-                result.append((propinfo[0], value))
-        except KeyError:
-            raise web.HTTPError(404)
-    return result
+    return compile_properties(source.__class__, properties)(source)
+
+def parse_accept_encoding(header):
+    """ Returns a dict of coding -> quality from an Accept-Encoding header """
+    accepted = {}
+    for part in header.split(','):
+        params = [p.strip() for p in part.split(';')]
+        quality = 1.0
+        for param in params[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if params[0]:
+            accepted[params[0].lower()] = quality
+    return accepted
+
+def make_compressor(encoding):
+    if encoding == 'gzip':
+        return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(COMPRESS_LEVEL)
+
+def compress(body, encoding):
+    compressor = make_compressor(encoding)
+    return compressor.compress(body) + compressor.flush()
+
+def make_entry(body, encoding):
+    """ Returns an (etag, body, encoding) response cache entry, compressing large bodies """
+    if encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+        body = compress(body, encoding)
+    else:
+        encoding = None
+    return ('"%s"' % hashlib.sha1(body).hexdigest(), body, encoding)
+
+def normalize_meta(meta):
+    """ Turns a meta= argument into a canonical tuple of property names """
+    return tuple(sorted(set(p for p in meta.split(',') if p)))
+
+def encode_record(obj, extractor):
+    """ Returns the encoded mlit record for an object, reusing cached fragments
+
+    Fragments are keyed by the object's serial rather than its id, which a
+    rebuilt library reuses, so they can never be served for another object.
+    """
+    return fragments.get((obj.serial, extractor.properties), lambda: ('mlit', extractor(obj)))
+
+def record_size(obj, extractor):
+    return fragments.size((obj.serial, extractor.properties), lambda: ('mlit', extractor(obj)))
+
+def encode_records(objects, extractor):
+    return [encode_record(o, extractor) for o in objects]
+
+def playing_time_nodes():
+    """ Returns the cant (remaining) and cast (total) nodes, in ms """
+    (elapsed, total) = mpd.get_current_time()
+    return [
+        ('cant', total - elapsed),
+        ('cast', total),
+    ]
+
+def encode_playstatus(revision):
+    """ Returns (player state, encoded cmst fields other than the playing time) """
+    player_state = mpd.get_property('dacp.playerstate')
+    node_list = [
+        ('mstt', 200),
+        ('cmsr', revision + 1),
+        ('caps', player_state),
+        ('cash', mpd.get_property('dacp.shufflestate')),
+        ('carp', mpd.get_property('dacp.repeatstate')),
+        ('cavc', mpd.get_property('dacp.volumecontrollable')),
+        ('caas', mpd.get_property('dacp.availableshufflestates')),
+        ('caar', mpd.get_property('dacp.availablerepeatstates')),
+    ]
+
+    if player_state != constants.PLAYER_STATE_STOPPED:
+        songinfo = mpd.get_current_track()
+        node_list += [
+            ('canp', mpd.get_property('dacp.nowplaying')),
+            ('cann', songinfo.get('title', '')),
+            ('cana', songinfo.get('artist', '')),
+            ('canl', songinfo.get('album', '')),
+            ('cang', songinfo.get('genre', '')),
+            ('asai', mpd.get_current_album_id),
+            ('cmmk', 1),
+            ('ceGS', 1),
+        ]
+
+    return (player_state, ''.join([dmapwriter.encode(n) for n in node_list]))
+
+def playstatus_update():
+    """ Returns the encoded cmst for the current revision
+
+    The snapshot is built once per revision and shared by every waiter;
+    only the playing time, which moves on between revisions, is encoded
+    per response.
+    """
+    revision = mpd.revision_number
+    snapshot = playstatus.get(revision)
+    if snapshot is None:
+        snapshot = playstatus.put(revision, encode_playstatus(revision))
+    (player_state, fields) = snapshot
+    if player_state == constants.PLAYER_STATE_STOPPED:
+        return dmapwriter.container('cmst', [fields])
+    return dmapwriter.container('cmst', [fields] + [dmapwriter.encode(n) for n in playing_time_nodes()])
 
 class DMAPRequestHandler(web.RequestHandler):
+    # Handlers whose output only depends on the request and the library
+    # generation can set this to serve repeat requests from the response cache
+    cache_responses = False
+
     def prepare(self):
         self.set_header('Content-Type', 'application/x-dmap-tagged')
         self.set_header('DAAP-Server', constants.DAAP_SERVER)
 
+        self.content_encoding = self.negotiate_encoding()
+        self.cache_key = None
+
+        if self.cache_responses and self.request.method == 'GET':
+            self.cache_key = self.get_cache_key()
+            entry = responses.get(self.cache_key + (self.content_encoding,))
+            if entry is None and self.content_encoding is not None:
+                # Compress each generation's response at most once per coding
+                identity = responses.get(self.cache_key + (None,))
+                if identity is not None:
+                    entry = responses.put(self.cache_key + (self.content_encoding,),
+                                          make_entry(identity[1], self.content_encoding))
+            if entry is not None:
+                self.write_entry(entry)
+                self.finish()
+
+    def negotiate_encoding(self):
+        if COMPRESS_LEVEL <= 0:
+            return None
+        self.set_header('Vary', 'Accept-Encoding')
+        accepted = parse_accept_encoding(self.request.headers.get('Accept-Encoding', ''))
+        for encoding in CONTENT_ENCODINGS:
+            if accepted.get(encoding, 0) > 0:
+                return encoding
+        return None
+
+    def get_cache_key(self):
+        arguments = tuple(sorted((k, tuple(v)) for (k, v) in self.request.arguments.iteritems()
+                                 if k not in UNCACHED_ARGUMENTS))
+        return (self.request.path, arguments, mpd.generation, mpd.playlist_generation)
+
+    def write_dmap(self, body):
+        """ Writes an encoded response, compressing and caching it where enabled """
+        if self.cache_key is None:
+            if self.content_encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+                self.set_header('Content-Encoding', self.content_encoding)
+                body = compress(body, self.content_encoding)
+            self.write(body)
+            return
+
+        entry = responses.put(self.cache_key + (None,), make_entry(body, None))
+        if self.content_encoding is not None:
+            entry = responses.put(self.cache_key + (self.content_encoding,),
+                                  make_entry(body, self.content_encoding))
+        self.write_entry(entry)
+
+    def write_listing(self, tag, fields, list_tag, collection, window, properties, trailer=()):
+        """ Writes a listing of collection[x] for x in window, streaming large ones
+
+        The collection is pinned for the whole response. Record lengths
+        are summed up front so the container headers can be written first,
+        then records are encoded and flushed STREAM_CHUNK_BYTES at a time.
+        """
+        # Validate the property list before anything is written
+        extractor = compile_properties(collection.item_class, properties)
+        if len(window) < STREAM_MIN_RECORDS:
+            records = [encode_record(collection[x], extractor) for x in window]
+            self.write_dmap(dmapwriter.listing(tag, fields, list_tag, records, trailer))
+            self.finish()
+            return
+
+        size = sum(record_size(collection[x], extractor) for x in window)
+        self.listing_tail = ''.join([dmapwriter.encode(t) for t in trailer])
+        head = dmapwriter.listing_head(tag, fields, list_tag, size, self.listing_tail)
+        if self.content_encoding is not None:
+            self.set_header('Content-Encoding', self.content_encoding)
+            self.compressor = make_compressor(self.content_encoding)
+        else:
+            self.set_header('Content-Length', len(head) + size + len(self.listing_tail))
+            self.compressor = None
+
+        records = (encode_record(collection[x], extractor) for x in window)
+        self.write_records(records, head)
+
+    def write_items(self, container, properties, query_string, sort_type):
+        """ Writes the items of a container, or only what changed since the delta= revision
+
+        Deltas list the changed records followed by a mudl of deleted ids.
+        A full listing is sent if the change log no longer reaches back far
+        enough.
+        """
+        collection = container.items
+        # Stored playlists keep the order their owner gave them
+        order = item_sort_order(query_string, sort_type) if container.is_base else None
+        ids = ordered_ids(collection, query_string, order)
+        total = len(ids)
+
+        delta = int(self.get_argument('delta', 0))
+        changes = mpd.changes_since(delta, mpd.change_scope(container)) if delta else None
+        trailer = []
+        if changes is not None:
+            (changed, deleted) = changes
+            ids = [x for x in ids if collection[x].id in changed]
+            trailer.append(('mudl', [('miid', id) for id in sorted(deleted)]))
+
+        window = ids[self.get_index_range()]
+        self.write_listing('apso', [
+            ('mstt', 200),
+            ('muty', 0 if changes is None else 1),
+            ('mtco', total),
+            ('mrco', len(window)),
+        ], 'mlcl', collection, window, properties, trailer)
+
+    def write_records(self, records, pending=''):
+        chunk = [pending]
+        size = len(pending)
+        for record in records:
+            chunk.append(record)
+            size += len(record)
+            if size >= STREAM_CHUNK_BYTES:
+                self.write_chunk(''.join(chunk))
+                self.flush(callback=lambda: self.write_records(records))
+                return
+        chunk.append(self.listing_tail)
+        self.write_chunk(''.join(chunk))
+        if self.compressor is not None:
+            self.write(self.compressor.flush())
+        self.finish()
+
+    def write_chunk(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self.write(data)
+
+    def write_entry(self, entry):
+        (etag, body, encoding) = entry
+        self.set_header('Etag', etag)
+        if self.etag_matches(etag):
+            self.set_status(304)
+            return
+        if encoding is not None:
+            self.set_header('Content-Encoding', encoding)
+        self.write(body)
+
+    def etag_matches(self, etag):
+        header = self.request.headers.get('If-None-Match')
+        if not header:
+            return False
+        tags = [t.strip() for t in header.split(',')]
+        return etag in tags or '*' in tags
+
+    def get_index_range(self):
+        """ Returns the slice requested by an inclusive 'index=start-end' argument """
+        value = self.get_argument('index', None)
+        if not value:
+            return slice(None)
+        match = INDEX_RANGE_REGEX.match(value)
+        if match is None:
+            raise web.HTTPError(400)
+        (start, end) = match.groups()
+        if end is None:
+            return slice(int(start), int(start) + 1)
+        elif end == '':
+            return slice(int(start), None)
+        return slice(int(start), int(end) + 1)
+
 class ServerInfoHandler(DMAPRequestHandler):
     def get(self):
-        node = dacpy.types.build_node(('msrv', [
+        node = dmapwriter.encode(('msrv', [
             ('mstt', 200),
             ('mpro', constants.DMAP_PROTOCOL_VERSION),
             ('apro', constants.DAAP_PROTOCOL_VERSION),
@@ -97,37 +493,43 @@ class ServerInfoHandler(DMAPRequestHandler):
             ('mstc', datetime.datetime.utcnow),
             ('msto', util.get_tz_offset)
         ]))
-        self.write(node.serialize())
+        self.write(node)
 
 class LoginHandler(DMAPRequestHandler):
     def get(self):
         guid = int(self.get_argument('pairing-guid'), 16)
         if PairingRecord.find(guid) is not None:
             sid = util.generate_sessionid(guid)
-            node = dacpy.types.build_node(('mlog', [
+            node = dmapwriter.encode(('mlog', [
                 ('mstt', 200),
                 ('mlid', sid),
             ]))
-            self.write(node.serialize())
+            self.write(node)
         else:
             raise web.HTTPError(503)
 
 class UpdateHandler(DMAPRequestHandler):
+    waiter = None
+
     @web.asynchronous
     def get(self):
-        mpd.register_update_callback(self.send_response, int(self.get_argument('revision-number', 1)))
+        self.waiter = mpd.waiters.wait(int(self.get_argument('revision-number', 1)),
+                                       self.send_response, LONGPOLL_TIMEOUT)
+
+    def on_connection_close(self):
+        mpd.waiters.cancel(self.waiter)
 
     def send_response(self):
-        node = dacpy.types.build_node(('mupd', [
+        node = dmapwriter.encode(('mupd', [
             ('mstt', 200),
-            ('musr', mpd.revision_number + 1),
+            ('musr', mpd.client_revision()),
         ]))
-        self.write(node.serialize())
+        self.write(node)
         self.finish()
 
 class DatabaseHandler(DMAPRequestHandler):
     def get(self):
-        node = dacpy.types.build_node(('avdb', [
+        node = dmapwriter.encode(('avdb', [
             ('mstt', 200),
             ('muty', False),
             ('mtco', 1),
@@ -143,55 +545,49 @@ class DatabaseHandler(DMAPRequestHandler):
                 ]),
             ]),
         ]))
-        self.write(node.serialize())
+        self.write(node)
 
 class DatabaseItemsHandler(DMAPRequestHandler):
+    @web.asynchronous
     def get(self, db):
-        properties = self.get_argument('meta').split(',')
+        properties = normalize_meta(self.get_argument('meta'))
         sort_type = self.get_argument('sort', None)
         query_type = self.get_argument('type', None)
         query_string = self.get_argument('query', '')
 
-        container = mpd.root_playlist
-
-        if query_string:
-            items = list(container.items.query(query_string))
-        else:
-            items = list(container.items)
-
-        if 'daap.songalbumid' in query_string:
-            items.sort(key=operator.attrgetter('track'))
-
-        item_nodes = [('mlit', fetch_properties(properties, i)) for i in items]
-
-        node = dacpy.types.build_node(('apso', [
-            ('mstt', 200),
-            ('muty', 0),
-            ('mtco', len(item_nodes)),
-            ('mrco', len(item_nodes)),
-            ('mlcl', item_nodes),
-        ]))
-
-        self.write(node.serialize())
+        self.write_items(mpd.root_playlist, properties, query_string, sort_type)
 
 class ContainersHandler(DMAPRequestHandler):
+    cache_responses = True
+
     def get(self, db):
-        properties = self.get_argument('meta').split(',')
+        extractor = compile_properties(mpd.containers.item_class, self.get_argument('meta').split(','))
+
+        delta = int(self.get_argument('delta', 0))
+        changes = mpd.changes_since(delta, 'containers') if delta else None
+        if changes is None:
+            containers = list(mpd.containers)
+        else:
+            containers = [c for c in mpd.containers if c.id in changes[0]]
 
-        container_nodes = [('mlit', fetch_properties(properties, c)) for c in mpd.containers]
+        container_nodes = [('mlit', extractor(c)) for c in containers]
 
-        node = dacpy.types.build_node(('aply', [
+        node_list = [
             ('mstt', 200),
             ('muty', 1),
             ('mtco', len(mpd.containers)),
-            ('mrco', len(mpd.containers)),
+            ('mrco', len(containers)),
             ('mlcl', container_nodes),
-        ]))
-        self.write(node.serialize())
+        ]
+        if changes is not None:
+            node_list.append(('mudl', [('miid', id) for id in sorted(changes[1])]))
+
+        self.write_dmap(dmapwriter.encode(('aply', node_list)))
 
 class ContainerItemsHandler(DMAPRequestHandler):
+    @web.asynchronous
     def get(self, db, container_id):
-        properties = self.get_argument('meta').split(',')
+        properties = normalize_meta(self.get_argument('meta'))
         sort_type = self.get_argument('sort', None)
         query_type = self.get_argument('type', None)
         query_string = self.get_argument('query', '')
@@ -201,51 +597,51 @@ class ContainerItemsHandler(DMAPRequestHandler):
         if container is None:
             raise web.HTTPError(400)
 
-        if query_string:
-            items = list(container.items.query(query_string))
-        else:
-            items = list(container.items)
-
-        if 'daap.songalbumid' in query_string:
-            items.sort(key=operator.attrgetter('track'))
-
-        item_nodes = [('mlit', fetch_properties(properties, i)) for i in items]
-
-        node = dacpy.types.build_node(('apso', [
-            ('mstt', 200),
-            ('muty', 0),
-            ('mtco', len(item_nodes)),
-            ('mrco', len(item_nodes)),
-            ('mlcl', item_nodes),
-        ]))
-
-        self.write(node.serialize())
+        self.write_items(container, properties, query_string, sort_type)
 
 class ContainerEditHandler(DMAPRequestHandler):
     def get(self, db, container_id):
         action = self.get_argument('action')
-        params = query_to_dict(self.get_argument('edit-params'))
+        params = self.get_argument('edit-params')
 
         container = mpd.containers.get_by_id(int(container_id))
+        if container is None or container.is_base:
+            raise web.HTTPError(404)
 
-        try:
-            if action == 'add':
-                self.add_to_container(container, int(params['dmap.itemid']))
-            else:
-                raise web.HTTPError(501)
-        except KeyError:
+        if action == 'add':
+            item_ids = query_values(params, 'dmap.itemid')
+        elif action == 'remove':
+            item_ids = query_values(params, 'dmap.containeritemid')
+        else:
+            raise web.HTTPError(501)
+        if not item_ids:
             raise web.HTTPError(404)
 
-    def add_to_container(self, container, item_id):
-        item = mpd.items.get_by_id(int(item_id))
-        if item:
-            container.add_item(item)
-            self.write(dacpy.types.build_node(('medc', [
-                ('mstt', 200),
-                ('mlit', []),
-            ])).serialize())
+        if action == 'add':
+            self.add_to_container(container, [int(x) for x in item_ids])
         else:
+            self.remove_from_container(container, [int(x) for x in item_ids])
+
+    def add_to_container(self, container, item_ids):
+        items = [mpd.items.get_by_id(x) for x in item_ids]
+        if None in items:
             raise web.HTTPError(204)
+        container.add_items(items)
+        self.write_edited()
+
+    def remove_from_container(self, container, item_ids):
+        # Every occurrence of each item is removed
+        positions = [container.get_item_positions(x) for x in item_ids]
+        if [] in positions:
+            raise web.HTTPError(404)
+        container.remove_items(sum(positions, []))
+        self.write_edited()
+
+    def write_edited(self):
+        self.write(dmapwriter.encode(('medc', [
+            ('mstt', 200),
+            ('mlit', []),
+        ])))
 
 
 class DatabaseEditHandler(DMAPRequestHandler):
@@ -264,35 +660,41 @@ class DatabaseEditHandler(DMAPRequestHandler):
     def add_playlist(self, name):
         pl = mpd.create_playlist(name)
 
-        self.write(dacpy.types.build_node(('medc', [
+        self.write(dmapwriter.encode(('medc', [
             ('mstt', 200),
             ('miid', pl.id),
-        ])).serialize())
+        ])))
 
 class GroupsHandler(DMAPRequestHandler):
+    cache_responses = True
+
     def get(self, db):
         query_string = self.get_argument('query')
         query_type = self.get_argument('type')
         group_type = self.get_argument('group-type')
         sort_type = self.get_argument('sort')
         include_headers = bool(int(self.get_argument('include-sort-headers', 0)))
-        properties = self.get_argument('meta').split(',')
+        # A rebuild may replace the collection while this request runs
+        albums = mpd.albums
+        extractor = compile_properties(albums.item_class,
+                                       normalize_meta(self.get_argument('meta') + ',dmap.itemcount'))
 
-        albums = util.sort_by_initial(mpd.albums.query(query_string), key=operator.attrgetter('name'))
+        order = 'artist' if sort_type == 'artist' else 'name'
+        ids = ordered_ids(albums, query_string, order)
+        window = ids[self.get_index_range()]
 
-        properties.append('dmap.itemcount')
-        name_nodes = [('mlit', fetch_properties(properties, a)) for a in albums]
+        records = encode_records((albums[x] for x in window), extractor)
 
         node_list = [
             ('mstt', 200),
             ('muty', 0),
-            ('mtco', len(albums)),
-            ('mrco', len(albums)),
-            ('mlcl', name_nodes),
+            ('mtco', len(ids)),
+            ('mrco', len(records)),
         ]
+        trailer = []
 
         if include_headers:
-            header_data = util.build_sort_headers([a.name for a in albums])
+            header_data = albums.sort_headers(order, query_string)
             header_nodes = []
             for (char, index, num) in header_data:
                 header_nodes.append(('mlit', [
@@ -300,10 +702,9 @@ class GroupsHandler(DMAPRequestHandler):
                     ('mshi', index),
                     ('mshn', num),
                 ]))
-            node_list.append(('mshl', header_nodes))
+            trailer.append(('mshl', header_nodes))
 
-        node = dacpy.types.build_node(('agal', node_list))
-        self.write(node.serialize())
+        self.write_dmap(dmapwriter.listing('agal', node_list, 'mlcl', records, trailer))
 
 class GroupArtHandler(DMAPRequestHandler):
     def get(self, db, group):
@@ -318,24 +719,28 @@ class GroupArtHandler(DMAPRequestHandler):
             raise web.HTTPError(404)
 
 class BrowseArtistHandler(DMAPRequestHandler):
+    cache_responses = True
+
     def get(self, db):
         filter_string = self.get_argument('filter')
         include_headers = bool(int(self.get_argument('include-sort-headers', 0)))
+        artists = mpd.artists
 
-        artists = util.sort_by_initial(mpd.artists.query(filter_string), key=operator.attrgetter('name'))
+        ids = ordered_ids(artists, filter_string, 'name')
+        window = ids[self.get_index_range()]
 
-        name_nodes = [('mlit', a.name) for a in artists]
+        name_nodes = [('mlit', artists[x].name) for x in window]
 
         node_list = [
             ('mstt', 200),
             ('muty', 0),
-            ('mtco', len(artists)),
-            ('mrco', len(artists)),
+            ('mtco', len(ids)),
+            ('mrco', len(name_nodes)),
             ('abar', name_nodes),
         ]
 
         if include_headers:
-            header_data = util.build_sort_headers([a.name for a in artists])
+            header_data = artists.sort_headers('name', filter_string)
             header_nodes = []
             for (char, index, num) in header_data:
                 header_nodes.append(('mlit', [
@@ -345,12 +750,12 @@ class BrowseArtistHandler(DMAPRequestHandler):
                 ]))
             node_list.append(('mshl', header_nodes))
 
-        node = dacpy.types.build_node(('abro', node_list))
-        self.write(node.serialize())
+        node = dmapwriter.encode(('abro', node_list))
+        self.write_dmap(node)
 
 class ControlInterfaceHandler(DMAPRequestHandler):
     def get(self):
-        node = dacpy.types.build_node(('caci', [
+        node = dmapwriter.encode(('caci', [
             ('mstt', 200),
             ('muty', 0),
             ('mtco', 1),
@@ -367,7 +772,7 @@ class ControlInterfaceHandler(DMAPRequestHandler):
                 ]),
             ]),
         ]))
-        self.write(node.serialize())
+        self.write(node)
 
 class CueHandler(DMAPRequestHandler):
     def get(self):
@@ -379,35 +784,40 @@ class CueHandler(DMAPRequestHandler):
             query_string = self.get_argument('query')
             index = int(self.get_argument('index'))
             sort_type = self.get_argument('sort')
-            self.command_play(query_string, index)
+            self.command_play(query_string, index, sort_type)
         else:
             raise web.HTTPError(501)
 
     def command_clear(self):
         mpd.clear_current()
 
-        self.write(dacpy.types.build_node(('cacr', [
+        self.write(dmapwriter.encode(('cacr', [
             ('mstt', 200),
             ('miid', 0),
-        ])).serialize())
-
-    def command_play(self, query_string, index):
-        items = list(mpd.items.query(query_string))
-        items.sort(key=operator.attrgetter('album.name', 'track'))
-
-        for i in items:
-            mpd.add_to_current(i.uri)
-        mpd.play(index)
+        ])))
+
+    def command_play(self, query_string, index, sort_type=None):
+        library = mpd.items
+        # index points into the item listing the client was sent, in its order
+        ids = ordered_ids(library, query_string, item_sort_order(query_string, sort_type))
+        tapped = library[ids[index]].uri if 0 <= index < len(ids) else None
+
+        conditions = findadd_conditions(query_string)
+        if conditions is not None:
+            # MPD queues the matches in its own order, so the tapped song is played by uri
+            mpd.play_found(conditions, tapped)
+        else:
+            mpd.play_items([library[x].uri for x in ids], index)
 
-        self.write(dacpy.types.build_node(('cacr', [
+        self.write(dmapwriter.encode(('cacr', [
             ('mstt', 200),
             ('miid', 0),
-        ])).serialize())
+        ])))
 
 
 class GetSpeakerHandler(DMAPRequestHandler):
     def get(self):
-        node = dacpy.types.build_node(('casp', [
+        node = dmapwriter.encode(('casp', [
             ('mstt', 200),
             ('mdcl', [
                 ('caia', 1),
@@ -415,7 +825,7 @@ class GetSpeakerHandler(DMAPRequestHandler):
                 ('msma', 0),
             ]),
         ]))
-        self.write(node.serialize())
+        self.write(node)
 
 class GetPropertyHandler(DMAPRequestHandler):
     def get(self):
@@ -429,57 +839,36 @@ class GetPropertyHandler(DMAPRequestHandler):
             properties.remove('dacp.nowplaying')
         if 'dacp.playingtime' in properties:
             properties.remove('dacp.playingtime')
+            node_list += playing_time_nodes()
 
         node_list += fetch_properties(properties, mpd)
-        node = dacpy.types.build_node(('cmgt', node_list))
-        self.write(node.serialize())
+        node = dmapwriter.encode(('cmgt', node_list))
+        self.write(node)
 
 class SetPropertyHandler(DMAPRequestHandler):
     def get(self):
         for (prop, values) in self.request.arguments.iteritems():
-            # Take the last instance of each property, to allow for duplicates
-            ret = mpd.set_property(prop, values[-1])
-            if ret is None:
+            if mpd.setter_for(prop) is None:
                 logging.info("Unknown Property: %s (Value = %s)" % (prop, values))
+                continue
+            # Take the last instance of each property, to allow for duplicates
+            property_queue.set(prop, values[-1])
         raise web.HTTPError(204)
 
 
 class PlayStatusUpdateHandler(DMAPRequestHandler):
+    waiter = None
+
     @web.asynchronous
     def get(self):
-        mpd.register_update_callback(self.send_response, int(self.get_argument('revision-number', 1)))
+        self.waiter = mpd.waiters.wait(int(self.get_argument('revision-number', 1)),
+                                       self.send_response, LONGPOLL_TIMEOUT)
 
-    def send_response(self):
-        player_state = mpd.get_property('dacp.playerstate')
-        node_list = [
-            ('mstt', 200),
-            ('cmsr', mpd.revision_number + 1),
-            ('caps', player_state),
-            ('cash', mpd.get_property('dacp.shufflestate')),
-            ('carp', mpd.get_property('dacp.repeatstate')),
-            ('cavc', mpd.get_property('dacp.volumecontrollable')),
-            ('caas', mpd.get_property('dacp.availableshufflestates')),
-            ('caar', mpd.get_property('dacp.availablerepeatstates')),
-        ]
+    def on_connection_close(self):
+        mpd.waiters.cancel(self.waiter)
 
-        if player_state != constants.PLAYER_STATE_STOPPED:
-            songinfo = mpd.get_current_track()
-            timeinfo = mpd.get_current_time()
-            node_list += [
-                ('canp', mpd.get_property('dacp.nowplaying')),
-                ('cann', songinfo.get('title', '')),
-                ('cana', songinfo.get('artist', '')),
-                ('canl', songinfo.get('album', '')),
-                ('cang', songinfo.get('genre', '')),
-                ('asai', mpd.get_current_album_id),
-                ('cmmk', 1),
-                ('ceGS', 1),
-                ('cant', timeinfo[1] - timeinfo[0]),
-                ('cast', timeinfo[1]),
-            ]
-
-        node = dacpy.types.build_node(('cmst', node_list))
-        self.write(node.serialize())
+    def send_response(self):
+        self.write(playstatus_update())
         self.finish()
 
 class NowPlayingArtHandler(DMAPRequestHandler):
@@ -75,15 +75,13 @@ class CurrentStatusJsonHandler(JinjaRequestHandler):
         track = mpd.get_current_item()
         status = mpd.get_current_status()
 
-        timeinfo = status.get('time', '0:0').split(':')
-
         self.write({
             'track': track.serialize_to_json(),
             'playlist': [x.serialize_to_json() for x in mpd.get_current_playlist()],
             'status': {
                 'playlist_index': int(status.get('song', 0)),
                 'next_index': int(status.get('nextsong', 0)),
-                'time': int(timeinfo[0]),
+                'time': mpd.get_current_time()[0] // 1000,
                 'volume': int(status.get('volume', 0)),
             },
         })
@@ -108,6 +108,7 @@ class MPDClient(object):
             # Database Commands
             "count":            self._fetch_object,
             "find":             self._fetch_songs,
+            "findadd":          self._fetch_nothing,
             "list":             self._fetch_list,
             "listall":          self._fetch_database,
             "listallinfo":      self._fetch_database,
@@ -20,22 +20,76 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import array
 import collections
+import itertools
 import logging
 import socket
 import threading
+import time
 
+import bitset
+import changelog
 import constants
+import events
 import mpdclient
 import util
 import query
+import search
+import waiters
 
+from cache import LRUCache
 from config import current as config
 
 __all__ = ['MPD', 'Container', 'Album', 'Artist', 'mpd']
 
 SERVER_NAME = u'MPD@%s'
 
+QUERY_RESULT_CACHE_SIZE = 128
+BITSET_CACHE_SIZE = 512
+
+# Results larger than 1/SORT_SCAN_RATIO of the collection are ordered by
+# filtering the permutation instead of sorting by rank
+SORT_SCAN_RATIO = 16
+
+SEARCH_PROPERTIES = ('dmap.itemname', 'daap.songartist', 'daap.songalbum')
+
+# Number of change sets kept for answering delta requests
+CHANGE_LOG_SIZE = 256
+
+# Idle subsystems that invalidate the mirrored status and currentsong
+STATUS_SUBSYSTEMS = ('player', 'mixer', 'options', 'playlist')
+CURRENT_SONG_SUBSYSTEMS = ('player', 'playlist')
+QUEUE_SUBSYSTEMS = ('playlist',)
+
+# Seconds that elapsed time is interpolated locally before resyncing with MPD
+ELAPSED_RESYNC_INTERVAL = 30
+
+# Seconds a mirrored result is trusted without an idle event, in case one was missed
+MIRROR_MAX_AGE = 10
+
+# Seconds an idler waits before reconnecting after losing MPD
+IDLE_RETRY_DELAY = 5
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Idle subsystems that MPD reports after each settable property changes
+PROPERTY_SUBSYSTEMS = {
+    'dmcp.volume': ('mixer',),
+    'dacp.shufflestate': ('options',),
+    'dacp.repeatstate': ('options',),
+    'dacp.playingtime': ('player',),
+}
+
+# Seconds to wait for the idle event caused by our own command
+ECHO_TIMEOUT = 2
+
+# Idle events within this many seconds of each other share one revision
+REVISION_WINDOW = float(config.get('mpd', 'revision_window', 0.05))
+
+# Most commands sent in one command list, e.g. when queueing files one by one
+QUEUE_BATCH_SIZE = 1000
+
 class InvalidItemError(ValueError):
     pass
 
@@ -74,10 +128,27 @@ class PropertyMeta(type):
 class PropertyMixin(object):
     __metaclass__ = PropertyMeta
 
+    # Named sort keys that IndexedCollection precomputes per generation
+    sort_orders = {}
+
+    # Index initial of each object under a sort order, for orders whose
+    # key starts with that initial (see IndexedCollection.sort_headers)
+    header_initials = {}
+
     def enumerate_properties(self):
         for (prop, func) in self._properties['get'].iteritems():
             yield (prop, func(self))
 
+    @classmethod
+    def getter_for(cls, name):
+        """ Returns the unbound getter for a property, or None if it is not supported """
+        return cls._properties['get'].get(name)
+
+    @classmethod
+    def setter_for(cls, name):
+        """ Returns the unbound setter for a property, or None if it is not supported """
+        return cls._properties['set'].get(name)
+
     def get_property(self, name):
         try:
             return self._properties['get'][name](self)
@@ -90,9 +161,13 @@ class PropertyMixin(object):
         except KeyError:
             return None
 
+# Never reused, unlike ids, which stay the same across library rebuilds
+object_serials = itertools.count(1)
+
 class MPDObjectMixin(object):
     def __init__(self, id):
         self.id = id
+        self.serial = next(object_serials)
         self.mpd = MPD.instance()
 
 class MPDMixin(object):
@@ -114,22 +189,54 @@ class MPDMixin(object):
         client.disconnect()
         return retval
 
+    def execute_list(self, commands):
+        """ Sends (command, arg, ...) tuples over one connection, QUEUE_BATCH_SIZE per command list """
+        client = self.get_connection()
+        results = []
+        try:
+            for start in xrange(0, len(commands), QUEUE_BATCH_SIZE):
+                client.command_list_ok_begin()
+                for command in commands[start:start + QUEUE_BATCH_SIZE]:
+                    getattr(client, command[0])(*command[1:])
+                results.extend(client.command_list_end())
+        finally:
+            client.disconnect()
+        return results
+
 class Container(PropertyMixin, MPDObjectMixin):
-    def __init__(self, id, name, is_base=False):
+    def __init__(self, id, name, is_base=False, library=None):
         MPDObjectMixin.__init__(self, id)
         self.name = name
         self.is_base = is_base
+        self.items = None
         # this MUST be zero for the remote to "see" the playlist
         self.parent_container_id = 0
 
         if self.is_base:
-            self.items = self.mpd.items
+            self.items = library if library is not None else self.mpd.items
+            self._positions = None
+        else:
+            self.reload(library)
+
+    def reload(self, library=None):
+        """ Reads the playlist back from MPD, resolving its files in library (the current one by default) """
+        if library is None:
+            library = self.mpd.items
+        plfiles = self.mpd.execute('listplaylist', self.name)
+        files = set(plfiles)
+        itemmap = dict([(x.uri, x) for x in library if x.uri in files])
+        self._set_items([itemmap[f] for f in plfiles if f in itemmap])
+
+    def _set_items(self, items):
+        if self.items is not None and list(self.items) == items[:len(self.items)]:
+            # Appending leaves the existing indexes valid
+            for item in items[len(self.items):]:
+                self.items.add_item(item)
         else:
-            plfiles = self.mpd.execute('listplaylist', self.name)
             self.items = IndexedCollection(Item)
-            itemmap = dict([(x.uri, x) for x in self.mpd.items if x.uri in plfiles])
-            for f in plfiles:
-                self.items.add_item(itemmap[f])
+            for item in items:
+                self.items.add_item(item)
+        self._positions = None
 
     def __str__(self):
         return 'Container: %s' % self.name
@@ -144,15 +251,80 @@ class Container(PropertyMixin, MPDObjectMixin):
             'items': [i.serialize_to_json() for i in self.items],
         }
 
+    def signature(self):
+        return (self.name, tuple(i.id for i in self.items))
+
+    def edit(self, operations):
+        """ Applies ('add', item), ('move', from, to) and ('delete', position) edits as one command list
+
+        The local copy is changed before MPD answers; the stored_playlist
+        event that follows reloads the playlists and reconciles any difference.
+        """
+        if self.is_base:
+            raise ValueError('The base playlist cannot be edited')
+        old = list(self.items)
+        items = list(old)
+        commands = []
+        for operation in operations:
+            if operation[0] == 'add':
+                items.append(operation[1])
+                commands.append(('playlistadd', self.name, operation[1].uri))
+            elif operation[0] == 'move':
+                (source, target) = operation[1:]
+                if not (0 <= source < len(items) and 0 <= target < len(items)):
+                    raise IndexError('Playlist position out of range')
+                items.insert(target, items.pop(source))
+                commands.append(('playlistmove', self.name, source, target))
+            elif operation[0] == 'delete':
+                if not 0 <= operation[1] < len(items):
+                    raise IndexError('Playlist position out of range')
+                del items[operation[1]]
+                commands.append(('playlistdelete', self.name, operation[1]))
+            else:
+                raise ValueError('Unknown playlist edit: %r' % (operation[0],))
+        if not commands:
+            return
+
+        self._set_items(items)
+        self.mpd.playlist_edited(self, old)
+        try:
+            self.mpd.execute_list(commands)
+        except (mpdclient.MPDError, socket.error):
+            # MPD may have applied part of the list, so ask it what it has
+            try:
+                self.reload()
+            except (mpdclient.MPDError, socket.error):
+                # Unreachable; keep the last confirmed copy until stored_playlist reloads it
+                self._set_items(old)
+            self.mpd.playlist_edited(self, items)
+            raise
+
     def add_item(self, item):
-        self.items.add_item(item)
-        self.mpd.execute('playlistadd', self.name, item.uri)
+        self.edit([('add', item)])
+
+    def add_items(self, items):
+        self.edit([('add', i) for i in items])
+
+    def move_item(self, source, target):
+        self.edit([('move', source, target)])
+
+    def remove_items(self, positions):
+        # From the end, so that each deletion leaves the remaining positions alone
+        self.edit([('delete', p) for p in sorted(set(positions), reverse=True)])
+
+    def get_item_positions(self, itemid):
+        """ Returns every position of an item in the playlist """
+        if self._positions is None:
+            positions = {}
+            for (index, item) in enumerate(self.items):
+                positions.setdefault(item.id, []).append(index)
+            self._positions = positions
+        return self._positions.get(itemid, [])
 
     def get_item_index(self, itemid):
-        for (index, item) in enumerate(self.items):
-            if item.id == itemid:
-                return index
-        return -1
+        """ Returns the first position of an item in the playlist, or -1 """
+        positions = self.get_item_positions(itemid)
+        return positions[0] if positions else -1
 
     @property_getter('dmap.itemname')
     def get_name(self):
@@ -180,9 +352,18 @@ class Container(PropertyMixin, MPDObjectMixin):
         return self.is_base
 
 class Artist(PropertyMixin, MPDObjectMixin):
+    sort_orders = {
+        'name': lambda a: (a.initial, a.name),
+    }
+
+    header_initials = {
+        'name': lambda a: a.initial,
+    }
+
     def __init__(self, id, name):
         MPDObjectMixin.__init__(self, id)
         self.name = name
+        self.initial = util.get_initial(name)
 
     def __str__(self):
         return 'Artist: %s' % self.name
@@ -197,6 +378,7 @@ class Artist(PropertyMixin, MPDObjectMixin):
         }
 
     @property_getter('dmap.itemname')
+    @property_getter('daap.songartist')
     def get_name(self):
         return self.name
 
@@ -206,11 +388,23 @@ class Artist(PropertyMixin, MPDObjectMixin):
         return self.id
 
 class Album(PropertyMixin, MPDObjectMixin):
+    sort_orders = {
+        'name': lambda a: (a.initial, a.name),
+        'artist': lambda a: ((a.artist.initial, a.artist.name), (a.initial, a.name)),
+    }
+
+    header_initials = {
+        'name': lambda a: a.initial,
+        'artist': lambda a: a.artist.initial,
+    }
+
     def __init__(self, id, name, artist):
         MPDObjectMixin.__init__(self, id)
         self.name = name
-        self.artist = self.mpd.artists.first({'dmap.itemname': artist})
-        self.item_count = len(self.mpd.execute('list', 'title', 'album', self.name))
+        self.initial = util.get_initial(name)
+        self.artist = artist
+        # Filled in from the items once they are indexed (see MPD._build_views)
+        self.item_count = 0
 
     def __str__(self):
         return 'Album: %s' % self.name
@@ -226,6 +420,7 @@ class Album(PropertyMixin, MPDObjectMixin):
         }
 
     @property_getter('dmap.itemname')
+    @property_getter('daap.songalbum')
     def get_name(self):
         return self.name
 
@@ -244,12 +439,20 @@ class Album(PropertyMixin, MPDObjectMixin):
         return self.item_count
 
 class Item(PropertyMixin, MPDObjectMixin):
+    sort_orders = {
+        'name': lambda i: (i.initial, i.name),
+        'artist': lambda i: ((getattr(i.artist, 'initial', ''), getattr(i.artist, 'name', '')),
+                             getattr(i.album, 'name', ''), i.track),
+        'album': lambda i: (getattr(i.album, 'name', ''), i.track),
+    }
+
     def __init__(self, id, name, uri, artist, album, track=1, year=None, composer=None, genre=None, time=0):
         MPDObjectMixin.__init__(self, id)
         self.uri = uri
         self.name = name
-        self.artist = self.mpd.artists.first({'dmap.itemname': artist})
-        self.album = self.mpd.albums.first({'dmap.itemname': album, 'daap.songartist': artist})
+        self.initial = util.get_initial(name)
+        self.artist = artist
+        self.album = album
         self.track = track
         self.item_kind = 2
         self.content_description = ''
@@ -259,6 +462,11 @@ class Item(PropertyMixin, MPDObjectMixin):
         self.genre = util.de_listify(genre or '')
         self.time = time
 
+    def signature(self):
+        """ Everything a client sees of this item, for detecting modifications """
+        return (self.name, self.uri, getattr(self.artist, 'id', None), getattr(self.album, 'id', None),
+                self.track, self.year, self.composer, self.genre, self.time)
+
     def __str__(self):
         return 'Item: %s' % self.name
 
@@ -340,8 +548,14 @@ class IndexedCollection(object):
 
         self._cls = cls
         self._items = []
+        self._results = LRUCache(QUERY_RESULT_CACHE_SIZE)
+        self._bitsets = LRUCache(BITSET_CACHE_SIZE)
+        self._sort_orders = {}
+        self._headers = LRUCache(QUERY_RESULT_CACHE_SIZE)
+        self._views = {}
         self.indexes = {}
-        self.ids = set()
+        self.search_indexes = {}
+        self.generation = 0
 
     def __len__(self):
         return len(self._items)
@@ -350,6 +564,17 @@ class IndexedCollection(object):
         for item in self._items:
             yield item
 
+    def __getitem__(self, position):
+        return self._items[position]
+
+    @property
+    def item_class(self):
+        return self._cls
+
+    @property
+    def ids(self):
+        return bitset.full(len(self))
+
     def add_new(self, **kwargs):
         if 'id' not in kwargs:
             kwargs['id'] = len(self)
@@ -357,33 +582,159 @@ class IndexedCollection(object):
 
     def add_item(self, item):
         list_index = len(self)
-        self.ids.add(list_index)
         self._items.append(item)
         for (prop, value) in item.enumerate_properties():
             if (prop not in self.indexes):
                 self.indexes[prop] = {}
             if (value not in self.indexes[prop]):
                 self.indexes[prop][value] = []
+                if prop in SEARCH_PROPERTIES and isinstance(value, basestring):
+                    if prop not in self.search_indexes:
+                        self.search_indexes[prop] = search.TrigramIndex()
+                    self.search_indexes[prop].add(value)
             self.indexes[prop][value].append(list_index)
+        self.generation += 1
         return item
 
-    def query(self, querystring):
-        return (self._items[x] for x in query.parse_query_string(querystring)(self))
+    def bitset(self, prop, value):
+        """ Returns the posting list for prop=value as a bitset (KeyError if absent) """
+        key = (self.generation, prop, value)
+        bits = self._bitsets.get(key)
+        if bits is None:
+            bits = self._bitsets.put(key, bitset.from_ids(self.indexes[prop][value]))
+        return bits
+
+    def match(self, prop, pattern):
+        """ Returns a bitset of items whose prop matches a wildcard pattern (KeyError if not searchable) """
+        key = (self.generation, prop, pattern, search.WILDCARD)
+        bits = self._bitsets.get(key)
+        if bits is None:
+            postings = self.indexes[prop]
+            ids = []
+            for value in self.search_indexes[prop].match(pattern):
+                ids.extend(postings[value])
+            ids.sort()
+            bits = self._bitsets.put(key, bitset.from_ids(ids))
+        return bits
+
+    def query_bits(self, querystring):
+        key = (self.generation, query.canonical_query(querystring))
+        bits = self._results.get(key)
+        if bits is None:
+            bits = self._results.put(key, query.compile_query(querystring)(self))
+        return bits
+
+    def query_ids(self, querystring):
+        return bitset.iter_ids(self.query_bits(querystring))
+
+    def sort_order(self, order):
+        """ Returns (permutation, ranks) arrays for a named sort order of this generation """
+        try:
+            (generation, perm, ranks) = self._sort_orders[order]
+            if generation == self.generation:
+                return (perm, ranks)
+        except KeyError:
+            pass
+        key = self._cls.sort_orders[order]
+        items = self._items
+        perm = array.array('l', sorted(xrange(len(items)), key=lambda x: key(items[x])))
+        ranks = array.array('l', perm)
+        for (rank, pos) in enumerate(perm):
+            ranks[pos] = rank
+        self._sort_orders[order] = (self.generation, perm, ranks)
+        return (perm, ranks)
+
+    def sorted_ids(self, bits, order=None):
+        """ Orders the ids of a bitset by a named sort order, or by position if None
+
+        The result may be the shared permutation array, so callers must not modify it.
+        """
+        if order is None or order not in self._cls.sort_orders:
+            return list(bitset.iter_ids(bits))
+        (perm, ranks) = self.sort_order(order)
+        if bits == self.ids:
+            return perm
+        if bitset.count(bits) * SORT_SCAN_RATIO > len(perm):
+            members = bin(bits)[:1:-1]
+            size = len(members)
+            return [x for x in perm if x < size and members[x] == '1']
+        return sorted(bitset.iter_ids(bits), key=ranks.__getitem__)
+
+    def add_view(self, prop, order):
+        """ Materializes the ids of every value of prop, in a named sort order """
+        (perm, ranks) = self.sort_order(order)
+        view = {}
+        for (value, ids) in self.indexes.get(prop, {}).iteritems():
+            view[value] = sorted(ids, key=ranks.__getitem__)
+        self._views[(prop, order)] = (self.generation, view)
+
+    def view_ids(self, querystring, order):
+        """ Returns the materialized ids for a single 'prop:value' query, or None if there are none
+
+        The result is shared with the view, so callers must not modify it.
+        """
+        expression = query.compile_query(querystring)
+        if type(expression) is not query.EqualsExpression:
+            return None
+        try:
+            (generation, view) = self._views[(expression.left.value, order)]
+        except KeyError:
+            return None
+        if generation != self.generation:
+            return None
+        return view.get(expression.right.value)
+
+    def ordered_ids(self, querystring, order=None):
+        """ Returns the ids matching a query (everything if empty) in a named sort order """
+        if not querystring:
+            return self.sorted_ids(self.ids, order)
+        ids = self.view_ids(querystring, order)
+        if ids is None:
+            ids = self.sorted_ids(self.query_bits(querystring), order)
+        return ids
+
+    def sort_headers(self, order, querystring=None):
+        """ Returns the (char, index, count) sort headers for a query under a named sort order """
+        key = (self.generation, order, query.canonical_query(querystring or ''))
+        headers = self._headers.get(key)
+        if headers is None:
+            initial = self._cls.header_initials[order]
+            items = self._items
+            headers = self._headers.put(key, util.build_initial_headers(
+                initial(items[x]) for x in self.ordered_ids(querystring, order)))
+        return headers
+
+    def ordered(self, order=None):
+        return (self._items[x] for x in self.sorted_ids(self.ids, order))
+
+    def query(self, querystring, order=None):
+        return (self._items[x] for x in self.sorted_ids(self.query_bits(querystring), order))
 
     def get_by_id(self, id):
         return self.first({'dmap.itemid': id})
 
     def get(self, props):
-        ids = []
+        bits = bitset.EMPTY
         for (prop, value) in props.iteritems():
             if prop in self.indexes and value in self.indexes[prop]:
-                ids.extend(self.indexes[prop][value])
-        return (self._items[x] for x in ids)
+                bits |= self.bitset(prop, value)
+        return (self._items[x] for x in bitset.iter_ids(bits))
+
+    def find(self, props):
+        """ Returns the first object matching every prop=value, or None """
+        postings = [self.indexes.get(prop, {}).get(value) for (prop, value) in props.iteritems()]
+        if not postings or None in postings:
+            return None
+        common = set(postings[0]).intersection(*postings[1:])
+        if common:
+            return self._items[min(common)]
+        return None
 
     def first(self, props):
-        l = list(self.get(props))
-        if len(l) > 0:
-            return l[0]
+        ids = [self.indexes[prop][value][0] for (prop, value) in props.iteritems()
+               if prop in self.indexes and value in self.indexes[prop]]
+        if len(ids) > 0:
+            return self._items[min(ids)]
         return None
 
 class MPDIdler(threading.Thread, MPDMixin):
@@ -409,11 +760,69 @@ class MPDIdler(threading.Thread, MPDMixin):
         self._done = True
 
     def run(self):
+        resync = False
         while not self._done:
-            self.execute('idle', self.subsystems)
-            with self._callback_lock:
-                for callback in self._callbacks:
-                    callback()
+            try:
+                if resync:
+                    # Anything may have changed while we were disconnected
+                    self.execute('ping')
+                    changed = list(self.subsystems)
+                    resync = False
+                else:
+                    changed = self.execute('idle', *self.subsystems)
+                with self._callback_lock:
+                    for callback in self._callbacks:
+                        callback(changed)
+            except (mpdclient.MPDError, socket.error), e:
+                logging.warning('Lost MPD while idling on %s: %s', ', '.join(self.subsystems), e)
+                resync = True
+                time.sleep(IDLE_RETRY_DELAY)
+
+class StatusMirror(object):
+    """ Caches the result of an MPD command until an idle event on one of its subsystems
+
+    Results older than max_age seconds are refetched regardless, so a
+    missed event can only leave the mirror stale for that long.
+    """
+    def __init__(self, fetch, subsystems, max_age=MIRROR_MAX_AGE):
+        self.fetch = fetch
+        self.subsystems = frozenset(subsystems)
+        self.max_age = max_age
+        self._value = None
+        self._fetched_at = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def get(self, max_age=None):
+        return self.get_with_time(max_age)[0]
+
+    def get_with_time(self, max_age=None):
+        """ Returns (value, monotonic time it was fetched), refetching if older than max_age seconds """
+        if max_age is None or (self.max_age is not None and self.max_age < max_age):
+            max_age = self.max_age
+        with self._lock:
+            (value, fetched_at, version) = (self._value, self._fetched_at, self._version)
+        if value is not None and max_age is not None and monotonic() - fetched_at > max_age:
+            value = None
+        if value is None:
+            fetched_at = monotonic()
+            value = self.fetch()
+            with self._lock:
+                # Don't store a result that an event has already made stale
+                if version == self._version:
+                    (self._value, self._fetched_at) = (value, fetched_at)
+        return (value, fetched_at)
+
+    def invalidate(self, changed=None):
+        if changed is None or self.subsystems.intersection(changed):
+            with self._lock:
+                self._value = None
+                self._version += 1
+
+    def subscribe(self, bus):
+        """ Invalidates this mirror on each change event for its subsystems """
+        for subsystem in self.subsystems:
+            bus.subscribe(events.for_subsystem(subsystem), lambda event: self.invalidate())
 
 class MPD(PropertyMixin, MPDMixin):
     def __init__(self, host, port, password=None):
@@ -423,18 +832,41 @@ class MPD(PropertyMixin, MPDMixin):
 
         self.server_name = self._get_server_name()
 
-        self._status_idler = MPDIdler('playlist, player, options, mixer', host, port, password)
+        self.events = events.EventBus()
+        self._status = StatusMirror(lambda: self.execute('status'), STATUS_SUBSYSTEMS)
+        self._current_song = StatusMirror(lambda: self.execute('currentsong'), CURRENT_SONG_SUBSYSTEMS)
+        self._queue = StatusMirror(lambda: self.execute('playlistinfo'), QUEUE_SUBSYSTEMS)
+        for mirror in (self._status, self._current_song, self._queue):
+            mirror.subscribe(self.events)
+        self.events.subscribe(events.StoredPlaylistChanged, self._stored_playlists_changed)
+
+        self.revision_number = 1
+        self.generation = 0
+        self.playlist_generation = 0
+        self.changes = changelog.ChangeLog(CHANGE_LOG_SIZE, self.revision_number)
+        self._signatures = None
+        self._artist_ids = changelog.IdMap()
+        self._album_ids = changelog.IdMap()
+        self._item_ids = changelog.IdMap()
+        self._container_ids = changelog.IdMap()
+        # Held while the library, playlists or their signatures change
+        self._library_lock = threading.RLock()
+        self._revision_lock = threading.Lock()
+        self._revision_timer = None
+        self._pending_changes = set()
+        self._echoes = {}
+        self.revision_changes = LRUCache(CHANGE_LOG_SIZE)
+        self.waiters = waiters.WaiterRegistry(self.revision_number)
+
+        self._status_idler = MPDIdler(('playlist', 'player', 'options', 'mixer', 'stored_playlist'),
+                                      host, port, password)
         self._status_idler.register_callback(self._update_event)
         self._status_idler.start()
 
-        self._db_idler = MPDIdler('database', host, port, password)
+        self._db_idler = MPDIdler(('database',), host, port, password)
         self._db_idler.register_callback(self.update_db)
         self._db_idler.start()
 
-        self.revision_number = 1
-        self._update_callbacks = {}
-        self._update_callbacks_lock = threading.Lock()
-
         self.update_db()
 
     @classmethod
@@ -449,58 +881,139 @@ class MPD(PropertyMixin, MPDMixin):
             hostname = socket.getfqdn()
         return SERVER_NAME % hostname
 
-    def register_update_callback(self, callback, revno):
-        if revno <= self.revision_number:
-            return callback()
-        if revno not in self._update_callbacks:
-            self._update_callbacks[revno] = []
-        self._update_callbacks[revno].append(callback)
+    def _update_event(self, changed=()):
+        for subsystem in changed:
+            self.events.publish(events.for_subsystem(subsystem)())
+        if changed and self._swallow_echo(changed):
+            return
+        self._queue_revision(changed)
+
+    def _queue_revision(self, changed):
+        """ Folds changed subsystems into the next revision, which is bumped when the window closes """
+        if REVISION_WINDOW <= 0:
+            return self._bump_revision(changed)
+        with self._revision_lock:
+            self._pending_changes.update(changed)
+            if self._revision_timer is not None:
+                return
+            timer = self._revision_timer = threading.Timer(REVISION_WINDOW, self._flush_revision)
+            timer.daemon = True
+        timer.start()
+
+    def _flush_revision(self):
+        with self._revision_lock:
+            changed = frozenset(self._pending_changes)
+            self._pending_changes.clear()
+            self._revision_timer = None
+        self._bump_revision(changed)
+
+    def _bump_revision(self, changed=()):
+        with self._revision_lock:
+            self.revision_number += 1
+            self.revision_changes.put(self.revision_number, frozenset(changed))
+            self.waiters.notify(self.revision_number)
+
+    def changes_at(self, revision):
+        """ Returns the idle subsystems that produced a revision, or None if it is too old """
+        return self.revision_changes.get(revision)
+
+    def _swallow_echo(self, changed):
+        """ Consumes expected echoes, returning True if that is all this event was
+
+        An event only counts as our echo if MPD now reports the values we
+        set; anything else was changed by another client and passes.
+        """
+        with self._revision_lock:
+            now = monotonic()
+            if not all(self._echoes.get(s, (0, None))[0] > now for s in changed):
+                return False
+            expected = [self._echoes[s][1] for s in changed]
+        if not all(self._echo_matches(name, value) for values in expected for (name, value) in values.iteritems()):
+            return False
+        with self._revision_lock:
+            for s in changed:
+                self._echoes.pop(s, None)
+        return True
 
-    def _update_event(self):
-        self.revision_number += 1
+    def _echo_matches(self, name, value):
+        """ Checks that MPD reports the value we set for a property """
         try:
-            with self._update_callbacks_lock:
-                callbacks = self._update_callbacks[self.revision_number]
-                for callback in callbacks:
-                    callback()
-                del self._update_callbacks[self.revision_number]
-        except KeyError:
-            pass
+            if name == 'dacp.playingtime':
+                # Playback moves on while the echo is on its way
+                return abs(self.get_current_time()[0] - int(value)) <= ECHO_TIMEOUT * 1000
+            return self.get_property(name) == int(value)
+        except (KeyError, ValueError, TypeError):
+            return False
+
+    def set_property(self, name, value, echo=False):
+        """ Sets a property; with echo, the idle events it causes don't bump the revision
+
+        An echoed write must be followed by settle_property() once the
+        value has stopped changing.
+        """
+        if echo:
+            now = monotonic()
+            deadline = now + ECHO_TIMEOUT
+            with self._revision_lock:
+                for s in PROPERTY_SUBSYSTEMS.get(name, ()):
+                    (expires, values) = self._echoes.get(s, (0, {}))
+                    values = dict(values) if expires > now else {}
+                    values[name] = value
+                    self._echoes[s] = (deadline, values)
+        return PropertyMixin.set_property(self, name, value)
+
+    def settle_property(self, name):
+        """ Publishes the final value of a property written with echo """
+        subsystems = PROPERTY_SUBSYSTEMS.get(name, ())
+        for subsystem in subsystems:
+            self.events.publish(events.for_subsystem(subsystem)())
+        self._queue_revision(subsystems)
 
     def _update_playlists(self):
-        self.containers = IndexedCollection(Container)
+        (self.containers, self.root_playlist) = self._build_playlists(self.items)
+
+    def _build_playlists(self, library):
+        """ Returns the containers, and the base one, for the items of a library """
+        containers = IndexedCollection(Container)
         playlists = [p['playlist'] for p in self.execute('listplaylists') if 'playlist' in p and p['playlist']]
         playlists.sort()
 
-        self.root_playlist = self.containers.add_new(name=constants.BASE_PLAYLIST, is_base=True)
+        root_playlist = containers.add_new(id=self._container_ids[(True, constants.BASE_PLAYLIST)],
+                                           name=constants.BASE_PLAYLIST, is_base=True, library=library)
 
         for p in playlists:
-            self.containers.add_new(name=p)
+            containers.add_new(id=self._container_ids[(False, p)], name=p, library=library)
+        return (containers, root_playlist)
 
-    def _update_artists(self):
-        self.artists = IndexedCollection(Artist)
+    def _build_artists(self):
+        artists = IndexedCollection(Artist)
         for n in (x for x in util.sort_by_initial(self.execute('list', 'artist')) if x):
-            self.artists.add_new(name=n)
+            artists.add_new(id=self._artist_ids[n], name=n)
+        return artists
 
-    def _update_albums(self):
-        self.albums = IndexedCollection(Album)
-        for a in self.artists:
+    def _build_albums(self, artists):
+        albums = IndexedCollection(Album)
+        for a in artists:
             for n in (x for x in self.execute('list', 'album', 'artist', a.name) if x):
-                self.albums.add_new(name=n, artist=a.name)
+                albums.add_new(id=self._album_ids[(a.name, n)], name=n, artist=a)
+        return albums
 
-    def _update_items(self):
-        self.items = IndexedCollection(Item)
+    def _build_items(self, artists, albums):
+        items = IndexedCollection(Item)
         for i in (x for x in self.execute('listallinfo', '') if 'title' in x):
             try:
                 track = int(str(i['track']).split('/')[0])
             except KeyError:
                 track = 1
+            artist = i.get('artist', '')
+            album = i.get('album', '')
             try:
-                self.items.add_new(
+                items.add_new(
+                    id = self._item_ids[i.get('file', '')],
                     name = i.get('title', ''),
                     uri = i.get('file', ''),
-                    artist = i.get('artist', ''),
-                    album = i.get('album', ''),
+                    artist = artists.first({'dmap.itemname': artist}),
+                    album = albums.find({'dmap.itemname': album, 'daap.songartist': artist}),
                     time = int(i.get('time', 0)),
                     composer = i.get('composer', ''),
                     genre = i.get('genre', ''),
@@ -508,24 +1021,136 @@ class MPD(PropertyMixin, MPDMixin):
                     track = track)
             except Exception, e:
                 logging.warning('Error adding %r: %s', i, e)
-
-
-    def update_db(self):
-        self._update_artists()
-        self._update_albums()
-        self._update_items()
-        self._update_playlists()
+        return items
+
+    def _build_views(self, albums, items):
+        """ Links artists to their albums and items, and albums to their items, in display order """
+        for order in ('name', 'artist'):
+            albums.add_view('daap.songartist', order)
+        items.add_view('daap.songartist', 'artist')
+        items.add_view('daap.songalbumid', 'album')
+        album_items = items.indexes.get('daap.songalbumid', {})
+        for album in albums:
+            album.item_count = len(album_items.get(album.id, ()))
+
+    def _library_signatures(self):
+        """ Returns scope -> {id: signature} for every scope in the change log """
+        items = dict((i.id, i.signature()) for i in self.items)
+        signatures = self._container_signatures(items)
+        signatures['items'] = items
+        return signatures
+
+    def _container_signatures(self, items):
+        """ Returns the signatures of the container scopes, given those of the items """
+        signatures = {
+            'containers': dict((c.id, c.signature()) for c in self.containers),
+        }
+        for c in self.containers:
+            # The base playlist holds every item, so it shares the 'items' scope
+            if not c.is_base:
+                signatures[('container', c.id)] = dict((i.id, items[i.id]) for i in c.items)
+        return signatures
+
+    def change_scope(self, container):
+        """ Returns the change log scope for the items of a container """
+        if container.is_base:
+            return 'items'
+        return ('container', container.id)
+
+    def record_changes(self, scope, changed=(), deleted=()):
+        """ Logs changed and deleted ids for a scope against the next revision """
+        self.changes.record(self.revision_number + 1, scope, changed, deleted)
+
+    def client_revision(self):
+        """ Returns the musr handed to clients, which is the next revision """
+        return self.revision_number + 1
+
+    def changes_since(self, client_revision, scope):
+        """ Returns (changed, deleted) since a client was sent client_revision, or None if too old """
+        # Changes made while that musr was current were logged against it, so include them
+        return self.changes.since(client_revision - 1, scope)
+
+    def playlist_edited(self, container, old_items):
+        """ Logs an edit of a stored playlist, and keeps it from being logged again when reconciled """
+        with self._library_lock:
+            self.playlist_generation += 1
+            scope = self.change_scope(container)
+            signatures = dict((i.id, i.signature()) for i in container.items)
+            (changed, deleted) = changelog.diff(dict((i.id, i.signature()) for i in old_items), signatures)
+            # Items that were moved count as changed too
+            changed.update(i.id for (pos, i) in enumerate(container.items)
+                           if pos >= len(old_items) or old_items[pos] is not i)
+            self.record_changes(scope, changed, deleted)
+            self.record_changes('containers', [container.id])
+            if self._signatures is not None:
+                self._signatures[scope] = signatures
+                self._signatures['containers'][container.id] = container.signature()
+
+    def _log_library_changes(self):
+        """ Records what changed since the last build in the change log, returning True if anything did """
+        old = self._signatures
+        self._signatures = self._library_signatures()
+        if old is None:
+            return False
+        return self._log_changes(old, self._signatures)
+
+    def _log_changes(self, old, new):
+        """ Records the differences between two sets of scope signatures, returning True if there were any """
+        modified = False
+        for scope in set(old) | set(new):
+            (changed, deleted) = changelog.diff(old.get(scope, {}), new.get(scope, {}))
+            self.record_changes(scope, changed, deleted)
+            modified = modified or bool(changed or deleted)
+        return modified
+
+    def update_db(self, changed=None):
+        with self._library_lock:
+            artists = self._build_artists()
+            albums = self._build_albums(artists)
+            items = self._build_items(artists, albums)
+            self._build_views(albums, items)
+            (containers, root_playlist) = self._build_playlists(items)
+
+            # Requests only ever see a complete library
+            (self.artists, self.albums, self.items) = (artists, albums, items)
+            (self.containers, self.root_playlist) = (containers, root_playlist)
+            self.generation += 1
+
+            modified = self._log_library_changes()
+            self.events.publish(events.DatabaseChanged())
+        if modified:
+            self._queue_revision(['database'])
+
+    def _stored_playlists_changed(self, event):
+        with self._library_lock:
+            if self._signatures is None:
+                # The library is still being built and will read the playlists itself
+                return
+            self._update_playlists()
+            self.playlist_generation += 1
+            # Only playlists changed, so the item signatures still hold
+            old = dict(self._signatures)
+            items = old.pop('items')
+            signatures = self._container_signatures(items)
+            self._log_changes(old, signatures)
+            signatures['items'] = items
+            self._signatures = signatures
 
     def root_playlist(self):
         return self.root_playlist
 
     def create_playlist(self, name):
-        self.execute('save', name)
-        self.execute('playlistclear', name)
-        return self.containers.add_new(name=name, is_base=False)
+        self.execute_list([('save', name), ('playlistclear', name)])
+        self.playlist_generation += 1
+        container = self.containers.add_new(id=self._container_ids[(False, name)], name=name, is_base=False)
+        self.record_changes('containers', [container.id])
+        return container
 
     def delete_playlist(self, name):
         self.execute('rm', name)
+        self.playlist_generation += 1
+        if (False, name) in self._container_ids:
+            self.record_changes('containers', deleted=[self._container_ids[(False, name)]])
 
     def load_playlist(self, name):
         self.execute('load', name)
@@ -536,6 +1161,34 @@ class MPD(PropertyMixin, MPDMixin):
     def add_to_current(self, uri):
         self.execute('add', uri)
 
+    def play_items(self, uris, pos=0):
+        """ Replaces the current playlist with the given files and plays the one at pos """
+        self.execute_list([('clear',)] + [('add', uri) for uri in uris] + [('play', pos)])
+
+    def play_found(self, conditions, uri=None):
+        """ Replaces the current playlist with a findadd of tag/value conditions and plays uri
+
+        MPD decides the order of the found files, so the one to play is looked up by uri.
+        """
+        client = self.get_connection()
+        try:
+            client.command_list_ok_begin()
+            client.clear()
+            client.findadd(*conditions)
+            if uri is not None:
+                client.playlistfind('file', uri)
+            results = client.command_list_end()
+            found = results[-1] if uri is not None else None
+            if found:
+                client.play(int(found[0]['pos']))
+            elif uri is not None:
+                # MPD's matching missed it; queue it anyway so the requested file still plays
+                client.playid(client.addid(uri))
+            else:
+                client.play(0)
+        finally:
+            client.disconnect()
+
     def toggle_play(self):
         if self.get_player_state() == constants.PLAYER_STATE_PLAYING:
             self.pause()
@@ -560,7 +1213,7 @@ class MPD(PropertyMixin, MPDMixin):
     @property_setter('dacp.playingtime')
     def seek(self, value):
         try:
-            songnum = self.execute('status')['song']
+            songnum = self.get_current_status()['song']
             self.execute('seek', songnum, int(int(value) / 1000))
             return True
         except KeyError:
@@ -575,7 +1228,7 @@ class MPD(PropertyMixin, MPDMixin):
 
     @property_getter('dacp.playerstate')
     def get_player_state(self):
-        status = self.execute('status')
+        status = self.get_current_status()
         try:
             return {
                 'stop': constants.PLAYER_STATE_STOPPED,
@@ -587,7 +1240,7 @@ class MPD(PropertyMixin, MPDMixin):
 
     @property_getter('dacp.repeatstate')
     def get_repeat_state(self):
-        status = self.execute('status')
+        status = self.get_current_status()
         if status['single'] == '1':
             return constants.REPEAT_STATE_SINGLE
         elif status['repeat'] == '1':
@@ -601,7 +1254,7 @@ class MPD(PropertyMixin, MPDMixin):
 
     @property_getter('dacp.shufflestate')
     def get_shuffle_state(self):
-        status = self.execute('status')
+        status = self.get_current_status()
         if status['random'] == '1':
             return constants.SHUFFLE_STATE_ON
         else:
@@ -639,7 +1292,7 @@ class MPD(PropertyMixin, MPDMixin):
 
     @property_getter('dmcp.volume')
     def get_volume(self):
-        return int(self.execute('status')['volume'])
+        return int(self.get_current_status()['volume'])
 
     @property_setter('dmcp.volume')
     def set_volume(self, value):
@@ -647,25 +1300,33 @@ class MPD(PropertyMixin, MPDMixin):
         return True
 
     def get_current_track(self):
-        return self.execute('currentsong')
+        """ Returns MPD's currentsong; shared, so callers must not modify it """
+        return self._current_song.get()
 
     def get_current_status(self):
-        return self.execute('status')
+        """ Returns MPD's status; shared, so callers must not modify it """
+        return self._status.get()
 
     def get_current_time(self):
-        status = self.execute('status')
+        """ Returns [elapsed, total] in ms, advancing elapsed locally while playing """
+        (status, fetched_at) = self._status.get_with_time(ELAPSED_RESYNC_INTERVAL)
         try:
-            return [1000 * int(x) for x in status['time'].split(':')]
-        except TypeError:
-            pass
-        except KeyError:
-            pass
-        return [0, 0]
+            (elapsed, total) = [int(x) for x in status['time'].split(':')]
+            elapsed = float(status.get('elapsed', elapsed))
+        except (KeyError, TypeError, ValueError):
+            return [0, 0]
+        if status.get('state') == 'play':
+            elapsed += monotonic() - fetched_at
+        elapsed = int(1000 * elapsed)
+        if total > 0:
+            # Streams have no length to stop at
+            elapsed = min(elapsed, 1000 * total)
+        return [elapsed, 1000 * total]
 
     @property_getter('daap.songalbumid')
     def get_current_album_id(self):
-        songinfo = self.execute('currentsong')
-        album = self.albums.first({
+        songinfo = self.get_current_track()
+        album = self.albums.find({
             'dmap.itemname': songinfo['album'],
             'daap.songalbumartist': songinfo['artist'],
         })
@@ -673,14 +1334,14 @@ class MPD(PropertyMixin, MPDMixin):
 
     @property_getter('daap.songartistid')
     def get_current_artist_id(self):
-        songinfo = self.execute('currentsong')
+        songinfo = self.get_current_track()
         artist = self.artists.first({
             'dmap.itemname': songinfo['artist'],
         })
         return artist.id
 
     def get_current_item(self):
-        songinfo = self.execute('currentsong')
+        songinfo = self.get_current_track()
         return self.items.first({
             'dmap.itemname': songinfo['title'],
             'daap.songartist': songinfo['artist'],
@@ -693,5 +1354,5 @@ class MPD(PropertyMixin, MPDMixin):
                 'dmap.itemname': x['title'],
                 'daap.songartist': x['artist'],
                 'daap.songalbum': x['album'],
-            }) for x in self.execute('playlistinfo'))
+            }) for x in self._queue.get())
 
@@ -0,0 +1,75 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+""" Coalesces bursts of property writes into one MPD command per window """
+
+import logging
+import time
+
+from tornado.ioloop import IOLoop
+
+__all__ = ['PropertyQueue']
+
+class PropertyQueue(object):
+    """ Keeps only the latest value written to each property within a window
+
+    The first write to an idle property is applied at once. Writes that
+    follow within window seconds only replace the pending value, which is
+    applied when the window closes. Once a property has been quiet for a
+    whole window, the target settles it: the idle events its own writes
+    caused are not passed on to clients, so they only see the final value.
+    Everything runs on the IOLoop.
+    """
+    def __init__(self, target, window, io_loop=None):
+        self.target = target
+        self.window = window
+        self._io_loop = io_loop
+        self._pending = {}
+        self._timeouts = {}
+
+    @property
+    def io_loop(self):
+        return self._io_loop or IOLoop.instance()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def set(self, prop, value):
+        if prop in self._timeouts:
+            self._pending[prop] = value
+        else:
+            self._apply(prop, value)
+
+    def _apply(self, prop, value):
+        try:
+            self.target.set_property(prop, value, echo=True)
+        except Exception, e:
+            logging.warning('Error setting %s to %r: %s', prop, value, e)
+        self._timeouts[prop] = self.io_loop.add_timeout(time.time() + self.window,
+                                                        lambda: self._tick(prop))
+
+    def _tick(self, prop):
+        del self._timeouts[prop]
+        if prop in self._pending:
+            self._apply(prop, self._pending.pop(prop))
+        else:
+            self.target.settle_property(prop)
@@ -20,12 +20,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import shlex
+import operator
 import re
-import StringIO
 import urllib
 
-__all__ = ['QuerySyntaxError', 'apply_query']
+import bitset
+
+from cache import LRUCache
+from search import is_pattern
+
+__all__ = ['QuerySyntaxError', 'apply_query', 'compile_query', 'canonical_query', 'equality_terms', 'plan', 'explain']
 
 TOKEN_GROUP_START = '('
 TOKEN_GROUP_END = ')'
@@ -35,7 +39,18 @@ TOKEN_OR = ','
 TOKEN_EQUAL = ':'
 TOKEN_NOTEQUAL = '!:'
 
-PARAMETER_REGEX = re.compile(r'(?u)\'(?P<property>.+?)(?P<operator>!?:)(?P<value>.*)\'')
+TOKEN_REGEX = re.compile(r"""(?u)
+    (?P<group_start>\()
+  | (?P<group_end>\))
+  | (?P<and>[+ ])
+  | (?P<or>,)
+  | '(?P<term>(?:[^'\\]|\\.)*)'
+""", re.VERBOSE)
+ESCAPE_REGEX = re.compile(r'(?u)\\(.)')
+
+COMPILED_CACHE_SIZE = 256
+
+compiled_queries = LRUCache(COMPILED_CACHE_SIZE)
 
 class QuerySyntaxError(Exception):
     pass
@@ -47,20 +62,53 @@ class IndexQuery(object):
 
     def __eq__(self, other):
         try:
-            return frozenset(self.collection.indexes[self.index][other])
+            return self.collection.bitset(self.index, other)
         except KeyError:
             return self.collection.ids
 
     def __ne__(self, other):
         try:
-            return frozenset(self.collection.ids - self.collection.indexes[self.index][other])
+            return self.collection.ids & ~self.collection.bitset(self.index, other)
         except KeyError:
             return self.collection.ids
 
+    def match(self, pattern):
+        try:
+            return self.collection.match(self.index, pattern)
+        except KeyError:
+            return self.collection.ids
+
+    def exclude(self, pattern):
+        try:
+            return self.collection.ids & ~self.collection.match(self.index, pattern)
+        except KeyError:
+            return self.collection.ids
+
+    def count(self, value):
+        try:
+            return len(self.collection.indexes[self.index][value])
+        except KeyError:
+            return len(self.collection)
+
+    def posting(self, value):
+        try:
+            return self.collection.bitset(self.index, value)
+        except KeyError:
+            return bitset.EMPTY
+
+    def matching(self, pattern):
+        try:
+            return self.collection.match(self.index, pattern)
+        except KeyError:
+            return bitset.EMPTY
+
 class Expression(object):
     def __call__(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def estimate(self, collection):
+        return len(collection)
+
 class UnaryExpression(Expression):
     def __init__(self, value):
         self.value = value
@@ -86,14 +134,14 @@ class BinaryExpression(Expression):
 
 class AndExpression(BinaryExpression):
     def __call__(self, *args, **kwargs):
-        return self.left(*args, **kwargs) & self.right(*args, **kwargs)
+        return plan(self, args[0]).execute(args[0])
 
     def __str__(self):
         return "(%s+%s)" % (self.left, self.right)
 
 class OrExpression(BinaryExpression):
     def __call__(self, *args, **kwargs):
-        return self.left(*args, **kwargs) | self.right(*args, **kwargs)
+        return plan(self, args[0]).execute(args[0])
 
     def __str__(self):
         return "(%s,%s)" % (self.left, self.right)
@@ -102,6 +150,9 @@ class EqualsExpression(BinaryExpression):
     def __call__(self, *args, **kwargs):
         return self.left(*args, **kwargs) == self.right(*args, **kwargs)
 
+    def estimate(self, collection):
+        return self.left(collection).count(self.right(collection))
+
     def __str__(self):
         return "'%s:%s'" % (self.left, self.right)
 
@@ -109,59 +160,257 @@ class NotEqualsExpression(BinaryExpression):
     def __call__(self, *args, **kwargs):
         return self.left(*args, **kwargs) != self.right(*args, **kwargs)
 
+    def estimate(self, collection):
+        return len(collection) - bitset.count(self.excluded(collection))
+
+    def excluded(self, collection):
+        """ The ids this expression removes, for use as a set difference """
+        return self.left(collection).posting(self.right(collection))
+
     def __str__(self):
         return "'%s!:%s'" % (self.left, self.right)
 
-def handle_expression(expression_token):
-    result = PARAMETER_REGEX.match(expression_token).groupdict()
+class MatchesExpression(EqualsExpression):
+    def __call__(self, *args, **kwargs):
+        return self.left(*args, **kwargs).match(self.right(*args, **kwargs))
+
+    def estimate(self, collection):
+        # Matches are memoized by the collection, so counting is exact and cheap
+        return bitset.count(self(collection))
+
+class NotMatchesExpression(NotEqualsExpression):
+    def __call__(self, *args, **kwargs):
+        return self.left(*args, **kwargs).exclude(self.right(*args, **kwargs))
+
+    def excluded(self, collection):
+        return self.left(collection).matching(self.right(collection))
+
+class PlanNode(object):
+    def __init__(self, estimate):
+        self.estimate = estimate
+
+    def execute(self, collection):
+        raise NotImplementedError()
+
+    def describe(self):
+        raise NotImplementedError()
+
+    def explain(self, depth=0):
+        lines = ['%s%s (est. %d)' % ('  ' * depth, self.describe(), self.estimate)]
+        for child in getattr(self, 'children', ()):
+            lines.append(child.explain(depth + 1))
+        return '\n'.join(lines)
+
+class ScanNode(PlanNode):
+    def __init__(self, expression, collection):
+        PlanNode.__init__(self, expression.estimate(collection))
+        self.expression = expression
+
+    def execute(self, collection):
+        return self.expression(collection)
+
+    def describe(self):
+        return 'SCAN %s' % self.expression
 
-    value = urllib.unquote_plus(result['value'])
+class ExcludeNode(ScanNode):
+    def execute(self, collection):
+        return self.expression.excluded(collection)
+
+    def describe(self):
+        return 'EXCLUDE %s' % self.expression
+
+class IntersectNode(PlanNode):
+    """ Intersects the smallest inputs first and subtracts negated terms last """
+    def __init__(self, children, excluded, collection):
+        children.sort(key=operator.attrgetter('estimate'))
+        if children:
+            estimate = children[0].estimate
+        else:
+            estimate = len(collection)
+        PlanNode.__init__(self, estimate)
+        self.children = children + excluded
+        self.included = children
+        self.excluded = excluded
+
+    def execute(self, collection):
+        if self.included:
+            result = self.included[0].execute(collection)
+            for child in self.included[1:]:
+                if result == bitset.EMPTY:
+                    return result
+                result &= child.execute(collection)
+        else:
+            result = collection.ids
+        for child in self.excluded:
+            if result == bitset.EMPTY:
+                break
+            result &= ~child.execute(collection)
+        return result
+
+    def describe(self):
+        return 'INTERSECT'
+
+class UnionNode(PlanNode):
+    def __init__(self, children, collection):
+        children.sort(key=operator.attrgetter('estimate'), reverse=True)
+        PlanNode.__init__(self, min(len(collection), sum(c.estimate for c in children)))
+        self.children = children
+
+    def execute(self, collection):
+        everything = collection.ids
+        result = bitset.EMPTY
+        for child in self.children:
+            result |= child.execute(collection)
+            if result == everything:
+                break
+        return result
+
+    def describe(self):
+        return 'UNION'
+
+def flatten(expression, cls):
+    if isinstance(expression, cls):
+        return flatten(expression.left, cls) + flatten(expression.right, cls)
+    return [expression]
+
+def plan(expression, collection):
+    """ Builds an evaluation plan ordered by the estimated size of each term """
+    if isinstance(expression, AndExpression):
+        included = []
+        excluded = []
+        for term in flatten(expression, AndExpression):
+            if isinstance(term, NotEqualsExpression):
+                excluded.append(ExcludeNode(term, collection))
+            else:
+                included.append(plan(term, collection))
+        return IntersectNode(included, excluded, collection)
+    elif isinstance(expression, OrExpression):
+        return UnionNode([plan(t, collection) for t in flatten(expression, OrExpression)], collection)
+    else:
+        return ScanNode(expression, collection)
+
+def explain(querystring, collection):
+    return plan(compile_query(querystring), collection).explain()
+
+def tokenize(querystring):
+    """ Splits a query into (kind, text) tokens in a single pass """
+    pos = 0
+    length = len(querystring)
+    while pos < length:
+        match = TOKEN_REGEX.match(querystring, pos)
+        if match is None:
+            raise QuerySyntaxError('Unknown or invalid token at %d: %r' % (pos, querystring[pos:]))
+        yield (match.lastgroup, match.group(match.lastgroup))
+        pos = match.end()
+
+def unquote(text):
+    if '%' not in text:
+        return text
+    if isinstance(text, unicode):
+        return urllib.unquote(text.encode('utf-8')).decode('utf-8', 'replace')
+    return urllib.unquote(text)
+
+def parse_value(text):
+    value = unquote(text)
     try:
-        value = int(value)
+        return int(value)
     except ValueError:
+        pass
+    if value[:2].lower() == '0x':
         try:
-            value = int(value, 16)
+            return int(value, 16)
         except ValueError:
             pass
+    return value
 
-    left = PropertyExpression(result['property'])
-    right = ConstantExpression(value)
+def build_comparison(term):
+    term = ESCAPE_REGEX.sub(r'\1', term)
+    try:
+        split = term.index(TOKEN_EQUAL)
+    except ValueError:
+        raise QuerySyntaxError('Missing operator in expression: %r' % term)
 
-    if result['operator'] == TOKEN_EQUAL:
-        return EqualsExpression(left, right)
-    elif result['operator'] == TOKEN_NOTEQUAL:
-        return NotEqualsExpression(left, right)
+    value = parse_value(term[split + 1:])
+    if term[:split].endswith('!'):
+        left = PropertyExpression(term[:split - 1])
+        cls = NotMatchesExpression if is_pattern(value) else NotEqualsExpression
     else:
-        raise QuerySyntaxError('Invalid operator in expression: %r' % expression_token)
-
-
-def handle_group(lexer):
-    stack = []
-
-    while True:
-        token = lexer.get_token()
-        if token == TOKEN_GROUP_END or token == '':
-            return stack.pop()
-        elif token == TOKEN_GROUP_START:
-            stack.append(handle_group(lexer))
-        elif token.startswith(TOKEN_QUOTE):
-            stack.append(handle_expression(token))
-        elif token in (TOKEN_AND, TOKEN_OR):
-            next_token = lexer.get_token()
-            right = None
-            if next_token == TOKEN_GROUP_START:
-                right = handle_group(lexer)
-            elif next_token.startswith(TOKEN_QUOTE):
-                right = handle_expression(next_token)
+        left = PropertyExpression(term[:split])
+        cls = MatchesExpression if is_pattern(value) else EqualsExpression
+    return cls(left, ConstantExpression(value))
+
+class Parser(object):
+    """ Recursive-descent parser for DACP queries
+
+    Operators are left-associative and share a single precedence level, so
+    mixed '+' and ',' chains must be grouped with parentheses.
+    """
+    def __init__(self, querystring):
+        self.tokens = tokenize(querystring)
+        self.advance()
+
+    def advance(self):
+        try:
+            self.current = self.tokens.next()
+        except StopIteration:
+            self.current = (None, None)
+
+    def parse(self):
+        expression = self.expression()
+        if self.current[0] is not None:
+            raise QuerySyntaxError('Unexpected token: %r' % self.current[1])
+        return expression
+
+    def expression(self):
+        left = self.operand()
+        while self.current[0] in ('and', 'or'):
+            kind = self.current[0]
+            self.advance()
+            right = self.operand()
+            if kind == 'and':
+                left = AndExpression(left, right)
             else:
-                raise QuerySyntaxError('Operators must preceed either a group or expression token')
-            if token == TOKEN_AND:
-                stack.append(AndExpression(stack.pop(), right))
-            elif token == TOKEN_OR:
-                stack.append(OrExpression(stack.pop(), right))
+                left = OrExpression(left, right)
+        return left
+
+    def operand(self):
+        (kind, text) = self.current
+        if kind == 'term':
+            self.advance()
+            return build_comparison(text)
+        elif kind == 'group_start':
+            self.advance()
+            expression = self.expression()
+            if self.current[0] != 'group_end':
+                raise QuerySyntaxError('Unterminated group')
+            self.advance()
+            return expression
+        elif kind is None:
+            raise QuerySyntaxError('Unexpected end of query')
         else:
-            raise QuerySyntaxError('Unknown or invalid token: %r' % token)
+            raise QuerySyntaxError('Operators must preceed either a group or expression token')
 
 def parse_query_string(querystring):
-    return handle_group(shlex.shlex(StringIO.StringIO(querystring.replace(' ', '+'))))
-
+    return Parser(querystring).parse()
+
+def canonical_query(querystring):
+    return querystring.strip()
+
+def compile_query(querystring):
+    """ Returns the expression tree for a query, reusing previously parsed trees """
+    key = canonical_query(querystring)
+    expression = compiled_queries.get(key)
+    if expression is None:
+        expression = compiled_queries.put(key, parse_query_string(key))
+    return expression
+
+def equality_terms(querystring):
+    """ Returns {property: value} for a query made only of ANDed exact matches, otherwise None """
+    terms = {}
+    for term in flatten(compile_query(querystring), AndExpression):
+        if type(term) is not EqualsExpression:
+            return None
+        (name, value) = (term.left.value, term.right.value)
+        if terms.setdefault(name, value) != value:
+            return None
+    return terms
@@ -0,0 +1,102 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import re
+
+import util
+
+__all__ = ['WILDCARD', 'TrigramIndex', 'is_pattern']
+
+WILDCARD = '*'
+
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+def is_pattern(value):
+    return isinstance(value, basestring) and WILDCARD in value
+
+def normalize(value):
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return util.clean_name(value)
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+class TrigramIndex(object):
+    """ Maps the cleaned form of every indexed value to its trigrams
+
+    Patterns use '*' as a wildcard and are matched against util.clean_name
+    of each value, so case and punctuation are ignored.
+    """
+    def __init__(self):
+        self.values = {}
+        self.grams = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        cleaned = normalize(value)
+        if cleaned not in self.values:
+            self.values[cleaned] = set()
+            for gram in trigrams(MARK_START + cleaned + MARK_END):
+                if gram not in self.grams:
+                    self.grams[gram] = set()
+                self.grams[gram].add(cleaned)
+        self.values[cleaned].add(value)
+
+    def candidates(self, pieces, anchor_start, anchor_end):
+        grams = set()
+        for (n, piece) in enumerate(pieces):
+            if n == 0 and anchor_start:
+                piece = MARK_START + piece
+            if n == len(pieces) - 1 and anchor_end:
+                piece = piece + MARK_END
+            grams.update(trigrams(piece))
+
+        if not grams:
+            return self.values.iterkeys()
+
+        postings = []
+        for gram in grams:
+            try:
+                postings.append(self.grams[gram])
+            except KeyError:
+                return ()
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def match(self, pattern):
+        """ Yields every raw value whose cleaned form matches the pattern """
+        pieces = [normalize(p) for p in pattern.split(WILDCARD)]
+        anchor_start = not pattern.startswith(WILDCARD)
+        anchor_end = not pattern.endswith(WILDCARD)
+        regex = re.compile('%s%s%s' % (
+            '^' if anchor_start else '',
+            '.*'.join(re.escape(p) for p in pieces),
+            '$' if anchor_end else ''))
+
+        for cleaned in self.candidates(pieces, anchor_start, anchor_end):
+            if regex.search(cleaned):
+                for value in self.values[cleaned]:
+                    yield value
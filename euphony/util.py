@@ -21,11 +21,13 @@
 # THE SOFTWARE.
 
 import datetime
+import itertools
 import random
 import re
 import string
 
-__all__ = ['generate_sessionid', 'build_sort_headers', 'sort_by_initial']
+__all__ = ['generate_sessionid', 'build_sort_headers', 'build_initial_headers', 'sort_by_initial',
+           'initial_key']
 
 SORT_LAST = 'ZZZ'
 SORT_DIGIT = '0'
@@ -54,34 +56,34 @@ def get_initial(name):
     except IndexError:
         return ''
 
+def initial_key(name):
+    """ Sort key that groups names by their index initial """
+    return (get_initial(name), name)
+
 def sort_by_initial(names, key=None):
     if not isinstance(names, list):
         names = list(names)
     if key is not None and callable(key):
-        names.sort(key=lambda x: ('%s %s' % (get_initial(key(x)), key(x))))
+        names.sort(key=lambda x: initial_key(key(x)))
     else:
-        names.sort(key=lambda x: ('%s %s' % (get_initial(x), x)))
+        names.sort(key=initial_key)
     return names
 
-def build_sort_headers(names):
-    nlist = sort_by_initial(names)
-
-    result = {}
+def build_initial_headers(initials):
+    """ Builds (char, index, count) sort headers from initials that are already in sort order """
+    result = []
     index = 0
-    for name in nlist:
-        initial = get_initial(name)
-        if initial in result:
-            result[initial][2] += 1
-        else:
-            if initial == SORT_LAST:
-                result[initial] = [ord(SORT_DIGIT), index, 1]
-            else:
-                result[initial] = [ord(initial), index, 1]
-        index += 1
+    for (initial, run) in itertools.groupby(initials):
+        count = sum(1 for i in run)
+        if initial == SORT_LAST:
+            result.append((ord(SORT_DIGIT), index, count))
+        elif initial:
+            result.append((ord(initial), index, count))
+        index += count
+    return result
 
-    keys = result.keys()
-    keys.sort()
-    return [tuple(result[k]) for k in keys]
+def build_sort_headers(names):
+    return build_initial_headers([get_initial(name) for name in sort_by_initial(names)])
 
 def get_tz_offset():
     now = datetime.datetime.now()
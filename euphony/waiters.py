@@ -0,0 +1,115 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+""" Long-poll waiters that can be woken from any thread """
+
+import threading
+import time
+
+from tornado.ioloop import IOLoop
+
+__all__ = ['Waiter', 'WaiterRegistry']
+
+class Waiter(object):
+    def __init__(self, registry, revision, callback):
+        self.registry = registry
+        self.revision = revision
+        self.callback = callback
+        self.timeout = None
+        self.done = False
+
+    def fire(self):
+        """ Runs the callback once; must be called on the IOLoop """
+        if self.done:
+            return
+        self.done = True
+        if self.timeout is not None:
+            self.registry.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+        self.callback()
+
+    def expire(self):
+        self.timeout = None
+        self.registry.discard(self)
+        self.fire()
+
+class WaiterRegistry(object):
+    """ Callbacks waiting for a revision, keyed by that revision
+
+    wait() and cancel() are called from the IOLoop, notify() from any
+    thread. Callbacks always run on the IOLoop. Only live waiters are
+    held: they are dropped when woken, cancelled or timed out.
+    """
+    def __init__(self, revision=0, io_loop=None):
+        self.revision = revision
+        self._io_loop = io_loop
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    @property
+    def io_loop(self):
+        return self._io_loop or IOLoop.instance()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(w) for w in self._waiters.itervalues())
+
+    def wait(self, revision, callback, timeout=None):
+        """ Calls callback once the registry reaches revision, or after timeout seconds """
+        waiter = Waiter(self, revision, callback)
+        with self._lock:
+            if revision > self.revision:
+                self._waiters.setdefault(revision, set()).add(waiter)
+                if timeout:
+                    waiter.timeout = self.io_loop.add_timeout(time.time() + timeout, waiter.expire)
+                return waiter
+        waiter.fire()
+        return waiter
+
+    def discard(self, waiter):
+        with self._lock:
+            waiting = self._waiters.get(waiter.revision)
+            if waiting is not None:
+                waiting.discard(waiter)
+                if not waiting:
+                    del self._waiters[waiter.revision]
+
+    def cancel(self, waiter):
+        """ Forgets a waiter without calling it, e.g. when its client disconnects """
+        if waiter is None:
+            return
+        self.discard(waiter)
+        waiter.done = True
+        if waiter.timeout is not None:
+            self.io_loop.remove_timeout(waiter.timeout)
+            waiter.timeout = None
+
+    def notify(self, revision):
+        """ Advances to revision and wakes everything waiting for it or earlier """
+        with self._lock:
+            self.revision = revision
+            woken = []
+            for r in [r for r in self._waiters if r <= revision]:
+                woken.extend(self._waiters.pop(r))
+        io_loop = self.io_loop
+        for waiter in woken:
+            io_loop.add_callback(waiter.fire)
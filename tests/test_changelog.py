@@ -0,0 +1,63 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from euphony import changelog
+from nose import tools
+
+class TestChangeLog:
+    def test_id_map(self):
+        ids = changelog.IdMap()
+        tools.assert_equals(ids['a.mp3'], 0)
+        tools.assert_equals(ids['b.mp3'], 1)
+        tools.assert_equals(ids['a.mp3'], 0)
+        tools.assert_true('b.mp3' in ids)
+        tools.assert_false('c.mp3' in ids)
+
+    def test_diff(self):
+        (changed, deleted) = changelog.diff({1: 'a', 2: 'b', 3: 'c'}, {1: 'a', 2: 'B', 4: 'd'})
+        tools.assert_equals(changed, set([2, 4]))
+        tools.assert_equals(deleted, set([3]))
+
+    def test_since(self):
+        log = changelog.ChangeLog(10, revision=1)
+        log.record(2, 'items', [1, 2])
+        log.record(3, 'items', [3], [2])
+        log.record(3, 'containers', [7])
+        log.record(4, 'items', [2])
+        tools.assert_equals(log.since(1, 'items'), (set([1, 2, 3]), set()))
+        tools.assert_equals(log.since(2, 'items'), (set([2, 3]), set()))
+        tools.assert_equals(log.since(3, 'items'), (set([2]), set()))
+        tools.assert_equals(log.since(4, 'items'), (set(), set()))
+        tools.assert_equals(log.since(2, 'containers'), (set([7]), set()))
+
+    def test_deleted(self):
+        log = changelog.ChangeLog(10, revision=1)
+        log.record(2, 'items', [1])
+        log.record(3, 'items', deleted=[1, 5])
+        tools.assert_equals(log.since(1, 'items'), (set(), set([1, 5])))
+
+    def test_truncation(self):
+        log = changelog.ChangeLog(2, revision=1)
+        for rev in (2, 3, 4):
+            log.record(rev, 'items', [rev])
+        tools.assert_equals(log.since(1, 'items'), None)
+        tools.assert_equals(log.since(2, 'items'), (set([3, 4]), set()))
@@ -0,0 +1,92 @@
+# coding: utf8
+
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import datetime
+import unittest
+
+try:
+    import dacpy.types
+except ImportError:
+    raise unittest.SkipTest('dacpy is not installed')
+
+from euphony import dmapwriter
+from nose import tools
+
+NODES = [
+    ('mstt', 200),
+    ('miid', 0),
+    ('mper', 0x1234567890abcdefL),
+    ('minm', 'Zaphod Beeblebrox'),
+    ('minm', u'Beeblebröx'),
+    ('minm', ''),
+    ('asar', u'トリリアン'),
+    ('msau', True),
+    ('mslr', False),
+    ('mpro', (2, 0, 6)),
+    ('msts', datetime.datetime(2010, 1, 1, 12, 0, 0)),
+    ('mlcl', []),
+    ('msrv', [
+        ('mstt', 200),
+        ('mpro', (2, 0, 6)),
+        ('minm', 'euphony'),
+        ('mstm', 1800),
+        ('msdc', 1),
+        ('msal', True),
+    ]),
+    ('adbs', [
+        ('mstt', 200),
+        ('muty', 0),
+        ('mtco', 2),
+        ('mrco', 2),
+        ('mlcl', [
+            ('mlit', [('miid', 1), ('minm', 'Marvin'), ('asar', 'Paranoid Android')]),
+            ('mlit', [('miid', 2), ('minm', u'Héart of Gold'), ('astn', 3)]),
+        ]),
+    ]),
+]
+
+class TestEncoder:
+    def test_matches_dacpy(self):
+        encoder = dmapwriter.Encoder()
+        for node in NODES:
+            expected = dacpy.types.build_node(node).serialize()
+            # Twice: once while compiling the writer, once with it cached
+            tools.assert_equal(encoder.encode(node), expected)
+            tools.assert_equal(encoder.encode(node), expected)
+
+    def test_callable_values(self):
+        encoder = dmapwriter.Encoder()
+        tools.assert_equal(encoder.encode(('mstt', lambda: 200)),
+                           dacpy.types.build_node(('mstt', 200)).serialize())
+
+    def test_small_then_large_values(self):
+        encoder = dmapwriter.Encoder()
+        for value in (1, 300, 70000, 0x123456789, -1, -70000):
+            tools.assert_equal(encoder.encode(('miid', value)),
+                               dacpy.types.build_node(('miid', value)).serialize())
+
+    def test_writer_key(self):
+        tools.assert_equal(dmapwriter.writer_key('miid', 2), dmapwriter.writer_key('miid', 3))
+        tools.assert_not_equal(dmapwriter.writer_key('miid', 1), dmapwriter.writer_key('miid', 70000))
+        tools.assert_not_equal(dmapwriter.writer_key('miid', 1), dmapwriter.writer_key('miid', -1))
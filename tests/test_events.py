@@ -0,0 +1,47 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from euphony import events
+from nose import tools
+
+class TestEventBus:
+    def test_typed_delivery(self):
+        bus = events.EventBus()
+        seen = []
+        bus.subscribe(events.MixerChanged, lambda e: seen.append(('mixer', e.subsystem)))
+        bus.subscribe(events.ChangeEvent, lambda e: seen.append(('any', e.subsystem)))
+        bus.publish(events.MixerChanged())
+        bus.publish(events.DatabaseChanged())
+        tools.assert_equals(seen, [('mixer', 'mixer'), ('any', 'mixer'), ('any', 'database')])
+
+    def test_for_subsystem(self):
+        tools.assert_equals(events.for_subsystem('stored_playlist'), events.StoredPlaylistChanged)
+        tools.assert_equals(events.for_subsystem('sticker'), events.ChangeEvent)
+
+    def test_unsubscribe(self):
+        bus = events.EventBus()
+        seen = []
+        callback = lambda e: seen.append(e)
+        bus.subscribe(events.PlayerChanged, callback)
+        bus.unsubscribe(events.PlayerChanged, callback)
+        bus.publish(events.PlayerChanged())
+        tools.assert_equals(seen, [])
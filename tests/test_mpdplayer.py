@@ -0,0 +1,452 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import socket
+import threading
+
+from euphony import cache, changelog, events, mpdclient, mpdplayer, waiters
+from nose import tools
+
+class TestStatusMirror:
+    def setup(self):
+        self.fetches = 0
+
+    def fetch(self):
+        self.fetches += 1
+        return {'volume': str(self.fetches)}
+
+    def test_caches_until_event(self):
+        mirror = mpdplayer.StatusMirror(self.fetch, ('mixer',))
+        tools.assert_equals(mirror.get()['volume'], '1')
+        tools.assert_equals(mirror.get()['volume'], '1')
+        mirror.invalidate(['player'])
+        tools.assert_equals(mirror.get()['volume'], '1')
+        mirror.invalidate(['mixer', 'player'])
+        tools.assert_equals(mirror.get()['volume'], '2')
+        mirror.invalidate()
+        tools.assert_equals(mirror.get()['volume'], '3')
+        tools.assert_equals(self.fetches, 3)
+
+    def test_stale_fetch_is_not_kept(self):
+        mirror = mpdplayer.StatusMirror(None, ('mixer',))
+        def fetch():
+            # An event arrives while the command is in flight
+            mirror.invalidate(['mixer'])
+            return self.fetch()
+        mirror.fetch = fetch
+        mirror.get()
+        mirror.get()
+        tools.assert_equals(self.fetches, 2)
+
+    def test_max_age(self):
+        now = [100.0]
+        monotonic = mpdplayer.monotonic
+        mpdplayer.monotonic = lambda: now[0]
+        try:
+            mirror = mpdplayer.StatusMirror(self.fetch, ('mixer',), max_age=10)
+            mirror.get()
+            now[0] += 5
+            tools.assert_equals(mirror.get()['volume'], '1')
+            tools.assert_equals(mirror.get(max_age=1)['volume'], '2')
+            now[0] += 11
+            tools.assert_equals(mirror.get(max_age=30)['volume'], '3')
+        finally:
+            mpdplayer.monotonic = monotonic
+
+class TestIdler:
+    def setup(self):
+        self.delay = mpdplayer.IDLE_RETRY_DELAY
+        mpdplayer.IDLE_RETRY_DELAY = 0
+        self.idler = mpdplayer.MPDIdler(('mixer', 'player'), 'localhost', 6600)
+        self.replies = [socket.error('Connection refused'), None, ['mixer']]
+        self.commands = []
+        self.idler.execute = self.execute
+        self.changes = []
+        self.idler.register_callback(self.changed)
+
+    def teardown(self):
+        mpdplayer.IDLE_RETRY_DELAY = self.delay
+
+    def execute(self, command, *args):
+        self.commands.append(command)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def changed(self, changed):
+        self.changes.append(changed)
+        if not self.replies:
+            self.idler.stop()
+
+    def test_reconnects_and_resyncs(self):
+        self.idler.run()
+        tools.assert_equals(self.commands, ['idle', 'ping', 'idle'])
+        tools.assert_equals(self.changes, [['mixer', 'player'], ['mixer']])
+
+class TestElapsedTime:
+    def setup(self):
+        self.now = 100.0
+        self.monotonic = mpdplayer.monotonic
+        mpdplayer.monotonic = lambda: self.now
+        self.status = {'state': 'play', 'time': '10:200', 'elapsed': '10.500'}
+        self.mpd = mpdplayer.MPD.__new__(mpdplayer.MPD)
+        self.mpd._status = mpdplayer.StatusMirror(lambda: self.status, mpdplayer.STATUS_SUBSYSTEMS)
+
+    def teardown(self):
+        mpdplayer.monotonic = self.monotonic
+
+    def test_interpolates_while_playing(self):
+        tools.assert_equals(self.mpd.get_current_time(), [10500, 200000])
+        self.now += 2
+        tools.assert_equals(self.mpd.get_current_time(), [12500, 200000])
+        self.now += 1000
+        tools.assert_equals(self.mpd.get_current_time(), [10500, 200000])
+
+    def test_stream_without_length(self):
+        self.status = {'state': 'play', 'time': '37:0'}
+        tools.assert_equals(self.mpd.get_current_time(), [37000, 0])
+        self.now += 2
+        tools.assert_equals(self.mpd.get_current_time(), [39000, 0])
+
+    def test_paused(self):
+        self.status['state'] = 'pause'
+        self.mpd.get_current_time()
+        self.now += 2
+        tools.assert_equals(self.mpd.get_current_time(), [10500, 200000])
+
+def build_mpd():
+    """ An MPD with just the revision bookkeeping, and no server behind it """
+    mpd = mpdplayer.MPD.__new__(mpdplayer.MPD)
+    mpd.events = events.EventBus()
+    mpd._status = mpdplayer.StatusMirror(lambda: {}, mpdplayer.STATUS_SUBSYSTEMS)
+    mpd._status.subscribe(mpd.events)
+    mpd._library_lock = threading.RLock()
+    mpd._revision_lock = threading.Lock()
+    mpd._revision_timer = None
+    mpd._pending_changes = set()
+    mpd._echoes = {}
+    mpd.revision_changes = cache.LRUCache(16)
+    mpd.revision_number = 1
+    mpd.changes = changelog.ChangeLog(16, 1)
+    mpd.waiters = waiters.WaiterRegistry(1)
+    mpd.execute = lambda *args: None
+    return mpd
+
+class TestEchoSuppression:
+    def setup(self):
+        self.window = mpdplayer.REVISION_WINDOW
+        mpdplayer.REVISION_WINDOW = 0
+        self.mpd = build_mpd()
+        self.status = {'volume': '40', 'random': '0', 'single': '0', 'repeat': '0'}
+        self.fetches = 0
+        self.mpd._status.fetch = self.fetch
+
+    def fetch(self):
+        self.fetches += 1
+        return dict(self.status)
+
+    def teardown(self):
+        mpdplayer.REVISION_WINDOW = self.window
+
+    def test_echo_is_swallowed_until_settled(self):
+        self.mpd.set_property('dmcp.volume', 40, echo=True)
+        self.mpd._update_event(['mixer'])
+        tools.assert_equals(self.mpd.revision_number, 1)
+        self.mpd.settle_property('dmcp.volume')
+        tools.assert_equals(self.mpd.revision_number, 2)
+        self.mpd._update_event(['mixer'])
+        tools.assert_equals(self.mpd.revision_number, 3)
+
+    def test_echo_still_invalidates_status(self):
+        self.mpd._status.get()
+        self.mpd.set_property('dmcp.volume', 40, echo=True)
+        self.mpd._update_event(['mixer'])
+        tools.assert_equals(self.fetches, 2)
+
+    def test_change_by_another_client_passes(self):
+        self.mpd.set_property('dmcp.volume', '40', echo=True)
+        self.status['volume'] = '75'
+        self.mpd._update_event(['mixer'])
+        tools.assert_equals(self.mpd.revision_number, 2)
+
+    def test_every_pending_value_must_match(self):
+        self.mpd.set_property('dacp.shufflestate', '1', echo=True)
+        self.mpd.set_property('dacp.repeatstate', '0', echo=True)
+        self.status['random'] = '1'
+        self.status['repeat'] = '1'
+        self.mpd._update_event(['options'])
+        tools.assert_equals(self.mpd.revision_number, 2)
+
+    def test_other_events_pass(self):
+        self.mpd.set_property('dmcp.volume', 40, echo=True)
+        self.mpd._update_event(['mixer', 'player'])
+        tools.assert_equals(self.mpd.revision_number, 2)
+
+class TestRevisionWindow:
+    def setup(self):
+        self.window = mpdplayer.REVISION_WINDOW
+        self.mpd = build_mpd()
+
+    def teardown(self):
+        mpdplayer.REVISION_WINDOW = self.window
+
+    def test_burst_is_one_revision(self):
+        mpdplayer.REVISION_WINDOW = 60
+        self.mpd._update_event(['player'])
+        self.mpd._update_event(['playlist'])
+        timer = self.mpd._revision_timer
+        tools.assert_equals(self.mpd.revision_number, 1)
+        # Close the window now instead of waiting for it
+        timer.cancel()
+        self.mpd._flush_revision()
+        tools.assert_equals(self.mpd.revision_number, 2)
+        tools.assert_equals(self.mpd.changes_at(2), frozenset(['player', 'playlist']))
+
+class TestDeltaRevisions:
+    def setup(self):
+        self.mpd = build_mpd()
+
+    def test_delta_from_musr(self):
+        # The musr a client gets from /update is what it later sends as delta=
+        musr = self.mpd.client_revision()
+        self.mpd.record_changes('containers', [5])
+        self.mpd._bump_revision(['stored_playlist'])
+        tools.assert_equals(self.mpd.changes_since(musr, 'containers'), (set([5]), set()))
+
+        musr = self.mpd.client_revision()
+        tools.assert_equals(self.mpd.changes_since(musr, 'containers'), (set(), set()))
+        self.mpd.record_changes('containers', deleted=[5])
+        self.mpd._bump_revision(['stored_playlist'])
+        tools.assert_equals(self.mpd.changes_since(musr, 'containers'), (set(), set([5])))
+
+class RecordingClient(object):
+    """ Stands in for an MPDClient, remembering the commands sent to it """
+    def __init__(self, found=()):
+        self.commands = []
+        self.found = list(found)
+
+    def __getattr__(self, command):
+        def send(*args):
+            self.commands.append((command,) + args)
+            if command == 'command_list_end':
+                return [None, None, self.found]
+            if command == 'addid':
+                return '7'
+        return send
+
+class TestQueueCommands:
+    def setup(self):
+        self.batch_size = mpdplayer.QUEUE_BATCH_SIZE
+        self.mpd = build_mpd()
+
+    def teardown(self):
+        mpdplayer.QUEUE_BATCH_SIZE = self.batch_size
+
+    def connect(self, client):
+        self.mpd.get_connection = lambda: client
+        return client
+
+    def test_play_items_batches_adds(self):
+        mpdplayer.QUEUE_BATCH_SIZE = 3
+        client = self.connect(RecordingClient())
+        self.mpd.play_items(['a', 'b', 'c'], 2)
+        tools.assert_equals(client.commands, [
+            ('command_list_ok_begin',), ('clear',), ('add', 'a'), ('add', 'b'),
+            ('command_list_end',), ('command_list_ok_begin',), ('add', 'c'), ('play', 2),
+            ('command_list_end',), ('disconnect',)])
+
+    def test_play_found_locates_uri(self):
+        client = self.connect(RecordingClient([{'file': 'b', 'pos': '5'}]))
+        self.mpd.play_found(['artist', 'Zaphod'], 'b')
+        tools.assert_equals(client.commands, [
+            ('command_list_ok_begin',), ('clear',), ('findadd', 'artist', 'Zaphod'),
+            ('playlistfind', 'file', 'b'), ('command_list_end',), ('play', 5), ('disconnect',)])
+
+    def test_play_found_without_match(self):
+        client = self.connect(RecordingClient())
+        self.mpd.play_found(['genre', 'Rock'], 'missing')
+        tools.assert_equals(client.commands[-3:], [('addid', 'missing'), ('playid', '7'), ('disconnect',)])
+
+    def test_play_found_without_uri(self):
+        client = self.connect(RecordingClient())
+        self.mpd.play_found(['genre', 'Rock'])
+        tools.assert_equals(client.commands, [
+            ('command_list_ok_begin',), ('clear',), ('findadd', 'genre', 'Rock'),
+            ('command_list_end',), ('play', 0), ('disconnect',)])
+
+class Track(mpdplayer.PropertyMixin):
+    def __init__(self, id, uri):
+        self.id = id
+        self.uri = uri
+
+    def signature(self):
+        return (self.uri,)
+
+    @mpdplayer.property_getter('dmap.itemid')
+    def get_id(self):
+        return self.id
+
+class FailingClient(RecordingClient):
+    def command_list_end(self):
+        raise mpdclient.CommandError('[50@0] {playlistmove} Bad song index')
+
+class TestPlaylistEdits:
+    def setup(self):
+        self.tracks = [Track(10 + n, uri) for (n, uri) in enumerate('abcd')]
+        self.mpd = build_mpd()
+        self.mpd.playlist_generation = 0
+        self.mpd._signatures = None
+        self.mpd.items = self.tracks
+        self.mpd.execute = lambda *args: ['a', 'b']
+        self.client = RecordingClient()
+        self.mpd.get_connection = lambda: self.client
+        self.container = mpdplayer.Container.__new__(mpdplayer.Container)
+        self.container.mpd = self.mpd
+        self.container.id = 5
+        self.container.name = 'Mix'
+        self.container.is_base = False
+        self.container.items = None
+        self.container.reload()
+
+    def uris(self):
+        return ''.join(i.uri for i in self.container.items)
+
+    def test_one_command_list(self):
+        self.container.edit([('add', self.tracks[2]), ('add', self.tracks[3]), ('move', 3, 0), ('delete', 2)])
+        tools.assert_equals(self.uris(), 'dac')
+        tools.assert_equals(self.client.commands, [
+            ('command_list_ok_begin',), ('playlistadd', 'Mix', 'c'), ('playlistadd', 'Mix', 'd'),
+            ('playlistmove', 'Mix', 3, 0), ('playlistdelete', 'Mix', 2), ('command_list_end',),
+            ('disconnect',)])
+        tools.assert_equals(self.mpd.changes.since(1, ('container', 5)), (set([10, 12, 13]), set([11])))
+
+    def test_positions(self):
+        self.container.add_items([self.tracks[0], self.tracks[2]])
+        tools.assert_equals(self.container.get_item_index(10), 0)
+        tools.assert_equals(self.container.get_item_index(12), 3)
+        self.container.remove_items([0, 1])
+        tools.assert_equals(self.uris(), 'ac')
+        tools.assert_equals(self.container.get_item_index(10), 0)
+        tools.assert_equals(self.container.get_item_index(11), -1)
+
+    def test_invalid_edit_sends_nothing(self):
+        tools.assert_raises(IndexError, self.container.edit, [('add', self.tracks[2]), ('delete', 3)])
+        tools.assert_equals(self.uris(), 'ab')
+        tools.assert_equals(self.client.commands, [])
+
+    def test_rejected_edit_reloads(self):
+        self.client = FailingClient()
+        tools.assert_raises(mpdclient.CommandError, self.container.move_item, 1, 0)
+        tools.assert_equals(self.uris(), 'ab')
+
+    def test_lost_connection_rolls_back(self):
+        def fail(*args):
+            raise mpdclient.ConnectionError('Connection lost while reading line')
+        self.mpd.get_connection = fail
+        self.mpd.execute = fail
+        tools.assert_raises(mpdclient.ConnectionError, self.container.add_items, self.tracks[2:])
+        tools.assert_equals(self.uris(), 'ab')
+
+    def test_duplicate_positions(self):
+        self.container.add_items([self.tracks[2], self.tracks[0]])
+        tools.assert_equals(self.container.get_item_positions(10), [0, 3])
+        tools.assert_equals(self.container.get_item_index(10), 0)
+        tools.assert_equals(self.container.get_item_positions(13), [])
+
+class TestItemSortKeys:
+    def test_missing_artist_and_album_sort_first(self):
+        item = mpdplayer.Item.__new__(mpdplayer.Item)
+        (item.artist, item.album, item.track) = (None, None, 3)
+        tools.assert_equals(mpdplayer.Item.sort_orders['artist'](item), (('', ''), '', 3))
+        tools.assert_equals(mpdplayer.Item.sort_orders['album'](item), ('', 3))
+
+class TestLibraryBuild:
+    def setup(self):
+        self.mpd = build_mpd()
+        self.mpd._artist_ids = changelog.IdMap()
+        self.mpd._album_ids = changelog.IdMap()
+        self.mpd._item_ids = changelog.IdMap()
+        self.mpd._container_ids = changelog.IdMap()
+        self.mpd._signatures = None
+        self.mpd.generation = 0
+        self.mpd.playlist_generation = 0
+        self.playlist = ['b1']
+        self.mpd.execute = self.execute
+        mpdplayer.MPD._instance = self.mpd
+
+    def teardown(self):
+        del mpdplayer.MPD._instance
+
+    def execute(self, command, *args):
+        if command == 'list' and args == ('artist',):
+            return ['Zaphod']
+        if command == 'list':
+            return ['Alpha', 'Beta']
+        if command == 'listplaylists':
+            return [{'playlist': 'Mix'}]
+        if command == 'listplaylist':
+            return self.playlist
+        # What a request would see while the library is being rebuilt
+        self.visible = (getattr(self.mpd, 'albums', None), self.mpd.generation)
+        return [
+            {'file': 'a1', 'title': 'One', 'artist': 'Zaphod', 'album': 'Alpha', 'track': '1'},
+            {'file': 'b1', 'title': 'Two', 'artist': 'Zaphod', 'album': 'Beta', 'track': '1'},
+            {'file': 'b2', 'title': 'Three', 'artist': 'Zaphod', 'album': 'Beta', 'track': '2'},
+        ]
+
+    def test_two_albums_by_one_artist(self):
+        self.mpd.update_db()
+        tools.assert_equals([(a.name, a.item_count) for a in self.mpd.albums], [('Alpha', 1), ('Beta', 2)])
+        tools.assert_equals([i.album.name for i in self.mpd.items], ['Alpha', 'Beta', 'Beta'])
+        beta = self.mpd.albums[1]
+        names = [self.mpd.items[x].name for x in self.mpd.items.ordered_ids("'daap.songalbumid:%d'" % beta.id, 'album')]
+        tools.assert_equals(names, ['Two', 'Three'])
+
+    def test_playlist_event_only_diffs_containers(self):
+        self.mpd.update_db()
+        mix = self.mpd.containers[1]
+        self.playlist = ['b1', 'a1']
+        signature = mpdplayer.Item.signature
+        def fail(item):
+            raise AssertionError('item signatures were recomputed')
+        mpdplayer.Item.signature = fail
+        try:
+            self.mpd._stored_playlists_changed(events.StoredPlaylistChanged())
+        finally:
+            mpdplayer.Item.signature = signature
+        a1 = self.mpd.items[0].id
+        tools.assert_equals(self.mpd.changes_since(self.mpd.client_revision(), ('container', mix.id)),
+                            (set([a1]), set()))
+        tools.assert_equals(self.mpd.changes_since(self.mpd.client_revision(), 'containers'),
+                            (set([mix.id]), set()))
+        tools.assert_equals(self.mpd.changes_since(self.mpd.client_revision(), 'items'), (set(), set()))
+
+    def test_rebuild_is_published_at_once(self):
+        self.mpd.update_db()
+        albums = self.mpd.albums
+        self.mpd.update_db()
+        tools.assert_equals(self.visible, (albums, 1))
+        tools.assert_equals(self.mpd.generation, 2)
+        tools.assert_true(self.mpd.albums is not albums)
+        tools.assert_true(self.mpd.root_playlist.items is self.mpd.items)
+        tools.assert_not_equal(self.mpd.albums[0].serial, albums[0].serial)
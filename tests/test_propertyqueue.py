@@ -0,0 +1,63 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from euphony import propertyqueue
+from nose import tools
+from tornado.ioloop import IOLoop
+
+class Target(object):
+    def __init__(self):
+        self.calls = []
+
+    def set_property(self, prop, value, echo=False):
+        self.calls.append(('set', prop, value))
+
+    def settle_property(self, prop):
+        self.calls.append(('settle', prop))
+
+class TestPropertyQueue:
+    def setup(self):
+        self.io_loop = IOLoop()
+        self.target = Target()
+        self.queue = propertyqueue.PropertyQueue(self.target, 0.01, io_loop=self.io_loop)
+
+    def teardown(self):
+        self.io_loop.close(all_fds=True)
+
+    def run_loop(self, seconds):
+        self.io_loop.add_timeout(self.io_loop.time() + seconds, self.io_loop.stop)
+        self.io_loop.start()
+
+    def test_coalesces_burst(self):
+        for volume in range(10, 60, 10):
+            self.queue.set('dmcp.volume', volume)
+        self.queue.set('dacp.shufflestate', 1)
+        tools.assert_equals(self.target.calls, [
+            ('set', 'dmcp.volume', 10),
+            ('set', 'dacp.shufflestate', 1),
+        ])
+        self.run_loop(0.05)
+        volume = [c for c in self.target.calls[2:] if c[1] == 'dmcp.volume']
+        tools.assert_equals(volume, [('set', 'dmcp.volume', 50), ('settle', 'dmcp.volume')])
+        shuffle = [c for c in self.target.calls[2:] if c[1] == 'dacp.shufflestate']
+        tools.assert_equals(shuffle, [('settle', 'dacp.shufflestate')])
+        tools.assert_equals(len(self.queue), 0)
@@ -0,0 +1,187 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from euphony import bitset, mpdplayer, query, util
+from nose import tools
+
+class Song(mpdplayer.PropertyMixin):
+    sort_orders = {
+        'name': lambda s: util.initial_key(s.name),
+        'artist': lambda s: (util.initial_key(s.artist), s.name),
+    }
+
+    header_initials = {
+        'name': lambda s: util.get_initial(s.name),
+    }
+
+    def __init__(self, id, name, artist):
+        self.id = id
+        self.name = name
+        self.artist = artist
+
+    @mpdplayer.property_getter('dmap.itemname')
+    def get_name(self):
+        return self.name
+
+    @mpdplayer.property_getter('dmap.itemid')
+    def get_id(self):
+        return self.id
+
+    @mpdplayer.property_getter('daap.songartist')
+    def get_artist(self):
+        return self.artist
+
+def build_collection():
+    songs = mpdplayer.IndexedCollection(Song)
+    songs.add_new(name='Marvin', artist='Paranoid Android')
+    songs.add_new(name='Heart of Gold', artist='Zaphod')
+    songs.add_new(name='Towel', artist='Arthur')
+    songs.add_new(name='Zaphod Beeblebrox', artist='Zaphod')
+    return songs
+
+class TestBitset:
+    def test_round_trip(self):
+        ids = [0, 3, 7, 8, 64, 1000]
+        bits = bitset.from_ids(ids)
+        tools.assert_equals(list(bitset.iter_ids(bits)), ids)
+        tools.assert_equals(bitset.count(bits), len(ids))
+        tools.assert_equals(bitset.from_ids([]), bitset.EMPTY)
+        tools.assert_equals(list(bitset.iter_ids(bitset.full(3))), [0, 1, 2])
+
+class TestParser:
+    def test_simple(self):
+        expr = query.parse_query_string("'daap.songartist:Zaphod'")
+        tools.assert_true(isinstance(expr, query.EqualsExpression))
+        tools.assert_equals(str(expr), "'daap.songartist:Zaphod'")
+
+    def test_groups(self):
+        expr = query.parse_query_string(
+            "('com.apple.itunes.mediakind:1','com.apple.itunes.mediakind:32') 'daap.songalbum!:'")
+        tools.assert_equals(str(expr),
+            "(('com.apple.itunes.mediakind:1','com.apple.itunes.mediakind:32')+'daap.songalbum!:')")
+
+    def test_values(self):
+        tools.assert_equals(query.parse_query_string("'dmap.itemid:42'").right.value, 42)
+        tools.assert_equals(query.parse_query_string("'dmap.persistentid:0x1F'").right.value, 31)
+        tools.assert_equals(query.parse_query_string("'dmap.itemname:abba'").right.value, 'abba')
+
+    def test_escaped_quotes(self):
+        expr = query.parse_query_string("'daap.songartist:Guns N\\' Roses'+'dmap.itemname:Me + You'")
+        tools.assert_equals(expr.left.right.value, "Guns N' Roses")
+        tools.assert_equals(expr.right.right.value, 'Me + You')
+
+    def test_percent_decoding(self):
+        expr = query.parse_query_string(u"'daap.songartist:Bj%C3%B6rk'")
+        tools.assert_equals(expr.right.value, u'Bj\xf6rk')
+
+    def test_equality_terms(self):
+        tools.assert_equals(query.equality_terms("'daap.songartist:Zaphod'+'daap.songalbumid:7'"),
+                            {'daap.songartist': 'Zaphod', 'daap.songalbumid': 7})
+        tools.assert_equals(query.equality_terms("'daap.songartist:Zaphod','daap.songartist:Arthur'"), None)
+        tools.assert_equals(query.equality_terms("'daap.songartist:Zaphod'+'daap.songalbum!:'"), None)
+        tools.assert_equals(query.equality_terms("'daap.songartist:*phod'"), None)
+        tools.assert_equals(query.equality_terms("'daap.songgenre:Rock'+'daap.songgenre:Pop'"), None)
+
+    def test_syntax_errors(self):
+        for bad in ("'dmap.itemname:x'+", "('dmap.itemname:x'", "'dmap.itemname'", "dmap.itemname:x"):
+            tools.assert_raises(query.QuerySyntaxError, query.parse_query_string, bad)
+
+class TestQuery:
+    def test_compile_cache(self):
+        first = query.compile_query("'daap.songartist:Zaphod'")
+        tools.assert_true(query.compile_query(" 'daap.songartist:Zaphod' ") is first)
+
+    def test_query_results(self):
+        songs = build_collection()
+        names = [s.name for s in songs.query("'daap.songartist:Zaphod'")]
+        tools.assert_equals(names, ['Heart of Gold', 'Zaphod Beeblebrox'])
+
+    def test_not_equals(self):
+        songs = build_collection()
+        names = [s.name for s in songs.query("'dmap.itemname!:Heart of Gold'+'daap.songartist:Zaphod'")]
+        tools.assert_equals(names, ['Zaphod Beeblebrox'])
+        names = [s.name for s in songs.query("'daap.songartist:Arthur','daap.songartist:Zaphod'")]
+        tools.assert_equals(names, ['Heart of Gold', 'Towel', 'Zaphod Beeblebrox'])
+
+    def test_wildcards(self):
+        songs = build_collection()
+        def names(q):
+            return [s.name for s in songs.query(q)]
+        tools.assert_equals(names("'dmap.itemname:*of*'"), ['Heart of Gold'])
+        tools.assert_equals(names("'dmap.itemname:zaphod*'"), ['Zaphod Beeblebrox'])
+        tools.assert_equals(names("'dmap.itemname:*el'"), ['Towel'])
+        tools.assert_equals(names("'dmap.itemname:*r*'"), ['Marvin', 'Heart of Gold', 'Zaphod Beeblebrox'])
+        tools.assert_equals(names("'dmap.itemname:h*gold'"), ['Heart of Gold'])
+        tools.assert_equals(names("'daap.songartist:*android*'"), ['Marvin'])
+        tools.assert_equals(names("'daap.songartist!:*zaphod*'"), ['Marvin', 'Towel'])
+        tools.assert_equals(names("'dmap.itemname:*xyz*'"), [])
+
+    def test_plan(self):
+        songs = build_collection()
+        q = "'daap.songartist:Zaphod'+'dmap.itemname:Towel'+'dmap.itemname!:Marvin'"
+        tools.assert_equals(query.explain(q, songs).splitlines(), [
+            'INTERSECT (est. 1)',
+            "  SCAN 'dmap.itemname:Towel' (est. 1)",
+            "  SCAN 'daap.songartist:Zaphod' (est. 2)",
+            "  EXCLUDE 'dmap.itemname!:Marvin' (est. 3)",
+        ])
+        tools.assert_equals(tuple(songs.query_ids(q)), ())
+        q = "'dmap.itemname!:Marvin'+'dmap.itemname!:Towel'"
+        tools.assert_equals(tuple(songs.query_ids(q)), (1, 3))
+
+    def test_sort_orders(self):
+        songs = build_collection()
+        names = [s.name for s in songs.ordered('name')]
+        tools.assert_equals(names, ['Heart of Gold', 'Marvin', 'Towel', 'Zaphod Beeblebrox'])
+        names = [s.name for s in songs.query("'daap.songartist!:Arthur'", 'artist')]
+        tools.assert_equals(names, ['Marvin', 'Heart of Gold', 'Zaphod Beeblebrox'])
+        names = [s.name for s in songs.query("'daap.songartist:Zaphod'", 'name')]
+        tools.assert_equals(names, ['Heart of Gold', 'Zaphod Beeblebrox'])
+        songs.add_new(name='Arthur Dent', artist='Arthur')
+        tools.assert_equals(songs.ordered('name').next().name, 'Arthur Dent')
+
+    def test_sort_headers(self):
+        songs = build_collection()
+        tools.assert_equals(songs.sort_headers('name'),
+                            [(ord('H'), 0, 1), (ord('M'), 1, 1), (ord('T'), 2, 1), (ord('Z'), 3, 1)])
+        tools.assert_equals(songs.sort_headers('name', "'daap.songartist:Zaphod'"),
+                            [(ord('H'), 0, 1), (ord('Z'), 1, 1)])
+        songs.add_new(name='Trillian', artist='Trillian')
+        tools.assert_equals(songs.sort_headers('name')[2], (ord('T'), 2, 2))
+
+    def test_views(self):
+        songs = build_collection()
+        songs.add_view('daap.songartist', 'name')
+        q = "'daap.songartist:Zaphod'"
+        tools.assert_equals(songs.view_ids(q, 'name'), [1, 3])
+        tools.assert_equals(songs.view_ids(q, 'artist'), None)
+        tools.assert_equals(songs.view_ids(q + "+'dmap.itemname:Towel'", 'name'), None)
+        tools.assert_equals(list(songs.ordered_ids(q, 'name')), [1, 3])
+        songs.add_new(name='Arthur Dent', artist='Zaphod')
+        tools.assert_equals(songs.view_ids(q, 'name'), None)
+        tools.assert_equals(list(songs.ordered_ids(q, 'name')), [4, 1, 3])
+
+    def test_result_cache_invalidation(self):
+        songs = build_collection()
+        tools.assert_equals(tuple(songs.query_ids("'daap.songartist:Arthur'")), (2,))
+        songs.add_new(name='Tea', artist='Arthur')
+        tools.assert_equals(tuple(songs.query_ids("'daap.songartist:Arthur'")), (2, 4))
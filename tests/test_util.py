@@ -38,6 +38,10 @@ class TestUtil:
         tools.assert_equals(headers[4], (ord('Z'), 5, 1))
         tools.assert_equals(headers[5], (ord('0'), 6, 1))
 
+    def test_initial_headers(self):
+        headers = util.build_initial_headers(['', 'A', 'A', 'M', util.SORT_LAST])
+        tools.assert_equals(headers, [(ord('A'), 1, 2), (ord('M'), 3, 1), (ord('0'), 4, 1)])
+
     def test_get_initial(self):
         tools.assert_equals(util.get_initial('The Heart of Gold'), 'H')
         tools.assert_equals(util.get_initial('"Magrathea"'), 'M')
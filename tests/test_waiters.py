@@ -0,0 +1,75 @@
+# The MIT License
+#
+# Copyright (c) 2010 Ryan Bergstrom
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+
+from euphony import waiters
+from nose import tools
+from tornado.ioloop import IOLoop
+
+class TestWaiterRegistry:
+    def setup(self):
+        self.io_loop = IOLoop()
+        self.registry = waiters.WaiterRegistry(revision=1, io_loop=self.io_loop)
+        self.fired = []
+
+    def teardown(self):
+        self.io_loop.close(all_fds=True)
+
+    def callback(self, name):
+        return lambda: self.fired.append(name)
+
+    def run_loop(self):
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.io_loop.start()
+
+    def test_current_revision_fires_immediately(self):
+        self.registry.wait(1, self.callback('a'))
+        tools.assert_equals(self.fired, ['a'])
+        tools.assert_equals(len(self.registry), 0)
+
+    def test_notify_from_thread(self):
+        self.registry.wait(2, self.callback('a'))
+        self.registry.wait(3, self.callback('b'))
+        thread = threading.Thread(target=self.registry.notify, args=(2,))
+        thread.start()
+        thread.join()
+        # Nothing runs off the IOLoop
+        tools.assert_equals(self.fired, [])
+        self.run_loop()
+        tools.assert_equals(self.fired, ['a'])
+        tools.assert_equals(len(self.registry), 1)
+
+    def test_cancel(self):
+        waiter = self.registry.wait(2, self.callback('a'))
+        self.registry.cancel(waiter)
+        tools.assert_equals(len(self.registry), 0)
+        self.registry.notify(2)
+        self.run_loop()
+        tools.assert_equals(self.fired, [])
+
+    def test_timeout(self):
+        self.registry.wait(2, self.callback('a'), timeout=0.01)
+        self.io_loop.add_timeout(self.io_loop.time() + 0.05, self.io_loop.stop)
+        self.io_loop.start()
+        tools.assert_equals(self.fired, ['a'])
+        tools.assert_equals(len(self.registry), 0)